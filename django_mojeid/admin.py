@@ -33,7 +33,7 @@ from django.contrib import admin
 from django.utils.translation import ugettext_lazy as _
 
 from django_mojeid.models import Nonce, Association, UserOpenID
-from django_mojeid.store import DjangoOpenIDStore
+from django_mojeid.store import get_store
 
 
 class NonceAdmin(admin.ModelAdmin):
@@ -41,7 +41,7 @@ class NonceAdmin(admin.ModelAdmin):
     actions = ['cleanup_nonces']
 
     def cleanup_nonces(self, request, queryset):
-        store = DjangoOpenIDStore()
+        store = get_store()
         count = store.cleanupNonces()
         self.message_user(request, _("%d expired nonces removed") % count)
     cleanup_nonces.short_description = _("Clean up expired nonces")
@@ -56,7 +56,7 @@ class AssociationAdmin(admin.ModelAdmin):
     actions = ['cleanup_associations']
 
     def cleanup_associations(self, request, queryset):
-        store = DjangoOpenIDStore()
+        store = get_store()
         count = store.cleanupAssociations()
         self.message_user(request, _("%d expired associations removed") % count)
     cleanup_associations.short_description = _("Clean up expired associations")
@@ -1,32 +1,120 @@
+import functools
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
 from django.utils.translation import ugettext_lazy as _
 
-_handlers = {}
+from django_mojeid.executors import call_timed, get_executor, register_task, task_stats
+from django_mojeid.mojeid import clear_attribute_plans
+
+TASK_PREFIX = 'mojeid.handler.'
 
 
 class HandlerNotFound(Exception):
     pass
 
 
-def register_handler(handler_name):
+def _run_deferred_handler(handler_name, user_id, value):
+    from django.contrib.auth import get_user_model
 
-    def function_wrapper(f):
+    # the user is loaded again as it could have been changed meanwhile
+    user = get_user_model()._default_manager.get(pk=user_id)
+    registry.get(handler_name).function(user, value)
 
-        def wrapped_function(*args, **kwargs):
-            return f(*args, **kwargs)
 
-        # This import is required to match the correct import
-        from django_mojeid.attribute_handlers import _handlers
+class Handler(object):
+    """ Registered handler function with its options """
+
+    def __init__(self, name, function, deferred=False, retries=0, timeout=None, order=0):
+        if not deferred and retries:
+            # the login would wait for the repeated runs
+            raise ImproperlyConfigured(
+                "Handler '%s': retries require deferred=True" % name)
+        self.name = name
+        self.function = function
+        self.deferred = deferred
+        self.retries = retries
+        self.timeout = timeout
+        self.order = order
+
+    @property
+    def task_name(self):
+        return TASK_PREFIX + self.name
+
+    def __call__(self, user, value):
+        if self.deferred:
+            # handlers of the same user are run in the order of the logins
+            get_executor().submit(self.task_name, (user.pk, value),
+                                  key='user:%s' % user.pk,
+                                  retries=self.retries, timeout=self.timeout)
+            return
+
+        # the inline handler can't be interrupted (it would be left running
+        # along with the login request), the timeout is just a soft budget
+        call_timed(self.task_name, self.function, (user, value), budget=self.timeout)
+
+
+class HandlerRegistry(object):
+
+    def __init__(self):
+        self._handlers = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, function, **options):
+        handler = Handler(name, function, **options)
+        with self._lock:
+            self._handlers[name] = handler
+        register_task(handler.task_name, functools.partial(_run_deferred_handler, name))
+        # the plans contain the resolved handlers
+        clear_attribute_plans()
+        return handler
 
-        # Store function into dict under handler name
-        _handlers[handler_name] = wrapped_function
+    def get(self, name):
+        try:
+            return self._handlers[name]
+        except KeyError:
+            raise HandlerNotFound(_('Handler with name %s was not found.') % name)
 
-        return wrapped_function
+    def resolve(self, custom_handlers):
+        """ Return [(custom_handler, handler)] in the order of the handlers """
+        resolved = [(x, self.get(x.name)) for x in custom_handlers]
+        # sort is stable, the handlers with the same order keep the settings order
+        return sorted(resolved, key=lambda x: x[1].order)
+
+    def stats(self):
+        """ Execution times (in seconds) of the handlers run by this process
+        {handler_name: {'count': ..., 'total': ..., 'max': ..., 'failures': ...,
+                        'timeouts': ..., 'budget_exceeded': ...,
+                        'p50': ..., 'p90': ..., 'p99': ...}} """
+        return dict((name[len(TASK_PREFIX):], stats) for name, stats in task_stats().items()
+                    if name.startswith(TASK_PREFIX))
+
+
+registry = HandlerRegistry()
+
+
+def register_handler(handler_name, deferred=False, retries=0, timeout=None, order=0):
+    """ Handlers are run in the ascending order.
+    Deferred handlers are run by the MOJEID_EXECUTOR after the login,
+    failed runs are repeated up to retries times.
+    A deferred run which takes more than timeout seconds is considered failed,
+    an inline run which exceeds it is just counted and logged.
+    Only the deferred handlers can have retries. """
+
+    def function_wrapper(f):
+        # This import is required to match the correct import
+        from django_mojeid.attribute_handlers import registry
+
+        registry.register(handler_name, f, deferred=deferred, retries=retries,
+                          timeout=timeout, order=order)
+        return f
 
     return function_wrapper
 
 
-def call_handler(handler_name, *args, **kwargs):
-    try:
-        _handlers[handler_name](*args, **kwargs)
-    except KeyError:
-        raise HandlerNotFound(_('Handler with name %s was not found.') % handler_name)
+def call_handler(handler_name, user, value):
+    registry.get(handler_name)(user, value)
+
+
+def handler_stats():
+    return registry.stats()
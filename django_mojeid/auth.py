@@ -31,20 +31,32 @@
 
 from __future__ import unicode_literals
 
+import logging
+
 from django.conf import settings
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ImproperlyConfigured, ValidationError
 from django.contrib.auth import get_user_model
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
 from django.utils.translation import ugettext_lazy as _
 
 from openid.consumer.consumer import SUCCESS
-from openid.extensions import ax
 
 from django_mojeid.exceptions import (
     IdentityAlreadyClaimed,
     DuplicateUserViolation,
 )
-from django_mojeid.mojeid import get_attributes
-from django_mojeid.attribute_handlers import call_handler
+from django_mojeid.executors import get_executor, register_task
+from django_mojeid.mojeid import (
+    get_attribute_plan,
+    get_attributes_digest,
+    get_ax_values,
+)
+from django_mojeid.settings import mojeid_settings
+
+logger = logging.getLogger(__name__)
+
+PROFILE_UPDATE_TASK = 'mojeid.profile_update'
 
 
 class OpenIDBackend:
@@ -77,20 +89,56 @@ class OpenIDBackend:
     def is_user_associated_with_openid(cls, user):
         if not user:
             return False
-        from django_mojeid.models import UserOpenID
-        return UserOpenID.objects.filter(user_id=user.pk).exists()
+        return cls.get_user_association(user) is not None
 
     @classmethod
     def get_user_association(cls, user):
         from django_mojeid.models import UserOpenID
         if not user:
             return None
+
+        # the association is remembered for the lifetime of the user object
         try:
-            association = UserOpenID.objects.get(user_id=user.pk)
-        except UserOpenID.DoesNotExist:
-            association = None
+            return user._mojeid_association
+        except AttributeError:
+            pass
+
+        cache = cls._get_identity_cache()
+        key = 'mojeid:user_association:%s' % user.pk
+        association = cache.get(key) if cache else None
+        if association is None:
+            try:
+                association = UserOpenID.objects.get(user_id=user.pk)
+            except UserOpenID.DoesNotExist:
+                # False is cached for the users without an association
+                association = False
+            if cache:
+                cache.set(key, association, mojeid_settings.MOJEID_IDENTITY_CACHE_TIMEOUT)
+
+        user._mojeid_association = association or None
+        return user._mojeid_association
 
-        return association
+    @staticmethod
+    def _get_identity_cache():
+        if not mojeid_settings.MOJEID_IDENTITY_CACHE_TIMEOUT:
+            return None
+        from django.core.cache.backends.locmem import LocMemCache
+        from django_mojeid.store import get_cache
+        cache = get_cache(mojeid_settings.MOJEID_CACHE)
+        if isinstance(cache, LocMemCache):
+            # the other processes would not see the invalidations
+            raise ImproperlyConfigured(
+                "MOJEID_IDENTITY_CACHE_TIMEOUT requires MOJEID_CACHE shared by all the processes, "
+                "'%s' is a local-memory cache" % mojeid_settings.MOJEID_CACHE)
+        return cache
+
+    @classmethod
+    def clear_identity_cache(cls, user_id):
+        """Remove the user and its association from the identity cache"""
+        cache = cls._get_identity_cache()
+        if cache:
+            cache.delete_many(['mojeid:user:%s' % user_id,
+                               'mojeid:user_association:%s' % user_id])
 
     @classmethod
     def get_redirect_to(cls, request):
@@ -145,114 +193,259 @@ class OpenIDBackend:
         if openid_response.status != SUCCESS:
             return None
 
-        user = None
         new_user = False
-        try:
-            user_openid = UserOpenID.objects.get(
-                claimed_id__exact=openid_response.identity_url)
-        except UserOpenID.DoesNotExist:
-            if getattr(settings, 'OPENID_CREATE_USERS', False):
+        user = self.get_user_by_claimed_id(openid_response.identity_url)
+        if user is None:
+            if getattr(settings, 'OPENID_CREATE_USERS', False) and \
+                    not UserOpenID.objects.filter(
+                        UserOpenID.claimed_id_filter(openid_response.identity_url)).exists():
                 user = self.create_user_from_openid(openid_response, attribute_set)
                 new_user = True
-        else:
-            user_model = get_user_model()
-            try:
-                user = user_model.objects.get(pk=user_openid.user_id)
-            except user_model.DoesNotExist:
-                user = None
 
         if user is None:
             return None
 
+        digest = None
+        unchanged = False
+        if mojeid_settings.MOJEID_SKIP_UNCHANGED_ATTRIBUTES or \
+                mojeid_settings.MOJEID_DEFERRED_PROFILE_UPDATE:
+            digest = get_attributes_digest(openid_response, attribute_set)
+            unchanged = not new_user and user.mojeid_attributes_digest == digest
+            if unchanged and mojeid_settings.MOJEID_SKIP_UNCHANGED_ATTRIBUTES:
+                # the attributes were already applied
+                return user
+
         if not new_user:
-            self.update_user_from_openid(user.pk, openid_response, attribute_set)
+            if mojeid_settings.MOJEID_DEFERRED_PROFILE_UPDATE:
+                if unchanged:
+                    # the same attributes were already applied,
+                    # submitting them again would just bump attributes_version
+                    digest = None
+                elif self.submit_profile_update(user.pk, openid_response, attribute_set,
+                                                digest=digest) is not None:
+                    # the digest is stored once the update is applied
+                    digest = None
+            else:
+                self.update_user_from_openid(user.pk, openid_response, attribute_set)
 
         # Run custom Attribute handler
         OpenIDBackend.run_handlers(openid_response, user, attribute_set)
 
+        if digest is not None:
+            UserOpenID.objects.filter(user_id=user.pk).update(attributes_digest=digest)
+
         return user
 
     @staticmethod
-    def get_model_changes(openid_response, only_updatable=False,
-                          attribute_set='default'):
+    def get_user_by_claimed_id(claimed_id):
+        """Return the user associated with the claimed_id using a single query.
+        The attributes digest of the association is set to mojeid_attributes_digest."""
+
+        from django_mojeid.models import UserOpenID
 
-        attributes = [x for x in get_attributes(attribute_set)
-                      if x.type in ['attribute', 'internal']]
+        user_model = get_user_model()
+        qn = connection.ops.quote_name
+        openid_table = qn(UserOpenID._meta.db_table)
+        user_table = qn(user_model._meta.db_table)
+
+        claimed_id_where, params = UserOpenID.claimed_id_where(claimed_id)
+        users = user_model.objects.extra(
+            select={
+                'mojeid_attributes_digest': '%s.%s' % (openid_table, qn('attributes_digest')),
+            },
+            tables=[UserOpenID._meta.db_table],
+            where=[
+                '%s.%s = %s.%s' % (openid_table, qn('user_id'),
+                                   user_table, qn(user_model._meta.pk.column)),
+                claimed_id_where,
+            ],
+            params=params,
+        )
+        try:
+            return users.get()
+        except user_model.DoesNotExist:
+            return None
 
-        fetch_response = ax.FetchResponse.fromSuccessResponse(openid_response)
+    @staticmethod
+    def get_model_changes(openid_response, only_updatable=False,
+                          attribute_set='default'):
 
-        res = {}
+        plan = get_attribute_plan(attribute_set)
 
         # filter remove non-updatable attributes
         if only_updatable:
-            attributes = [x for x in attributes if x.updatable]
+            attributes_by_model = plan.updatable_by_model
+        else:
+            attributes_by_model = plan.by_model
 
-        for attribute in attributes:
-            if attribute.model not in res:
-                res[attribute.model] = {'user_id_field_name': attribute.user_id_field_name}
-            val = attribute.get_value(fetch_response, attribute.required,
-                                      openid_response=openid_response)
+        ax_values = get_ax_values(openid_response)
 
-            if val is not None:
-                res[attribute.model][attribute.modelAttribute] = val
+        res = {}
+
+        for model, attributes in attributes_by_model.items():
+            res[model] = {'user_id_field_name': attributes[0].user_id_field_name}
+            for attribute in attributes:
+                val = attribute.get_value(ax_values, attribute.required,
+                                          openid_response=openid_response)
+
+                if val is not None:
+                    res[model][attribute.modelAttribute] = val
 
         return res
 
     @staticmethod
     def run_handlers(openid_response, user, attribute_set='default'):
-        handlers = [x for x in get_attributes(attribute_set) if x.type == 'handler']
+        handlers = get_attribute_plan(attribute_set).handlers
 
         if not handlers:
             return
 
-        fetch_response = ax.FetchResponse.fromSuccessResponse(openid_response)
+        ax_values = get_ax_values(openid_response)
 
-        for handler in handlers:
-            val = handler.attribute.get_value(fetch_response, handler.required, openid_response)
-            call_handler(handler.name, user, val)
+        for custom_handler, handler in handlers:
+            val = custom_handler.attribute.get_value(
+                ax_values, custom_handler.required, openid_response)
+            handler(user, val)
 
     def create_user_from_openid(self, openid_response, attribute_set='default'):
+        from django_mojeid.models import UserOpenID
+
         changes = OpenIDBackend.get_model_changes(openid_response, attribute_set=attribute_set)
 
         user_model = get_user_model()
 
         # Id will be generated no need to set this field
-        del changes[user_model]['user_id_field_name']
+        user_kwargs = changes.pop(user_model, {})
+        user_kwargs.pop('user_id_field_name', None)
 
-        # Create the main user structure
-        user = user_model(**changes[user_model])
-        try:
-            user.validate_unique()
-        except ValidationError as e:
-            raise DuplicateUserViolation(", ".join(e.messages))
-        user.save()
-
-        # User created remove it from the dict
-        del changes[user_model]
-
-        # Create other structures
-        for model, kwargs in changes.items():
-            foreign_key_name = kwargs['user_id_field_name']
-            del kwargs['user_id_field_name']
-            kwargs[foreign_key_name] = user.pk
-            m = model(**kwargs)
-            m.save()
+        with transaction.atomic():
+            # Create the main user structure
+            user = user_model(**user_kwargs)
+            try:
+                # Duplicities are detected by the unique constraints
+                with transaction.atomic():
+                    user.save(force_insert=True)
+            except IntegrityError:
+                # Only the unique violations are reported as duplicate users
+                try:
+                    user.validate_unique()
+                except ValidationError as e:
+                    raise DuplicateUserViolation(", ".join(e.messages))
+                raise
+
+            # Create other structures
+            for model, kwargs in changes.items():
+                foreign_key_name = kwargs.pop('user_id_field_name')
+                kwargs[foreign_key_name] = user.pk
+                model.objects.create(**kwargs)
 
-        OpenIDBackend.associate_openid_response(user, openid_response)
+            try:
+                with transaction.atomic():
+                    UserOpenID.objects.create(
+                        user_id=user.pk, claimed_id=openid_response.identity_url)
+            except IntegrityError:
+                raise IdentityAlreadyClaimed(
+                    _("The identity %s has already been claimed")
+                    % openid_response.identity_url)
 
         return user
 
     @classmethod
     def update_user_from_openid(cls, user_id, openid_response, attribute_set='default'):
+        """Write the updatable attributes which differ from the stored ones.
+        Returns the changed values {model: {field: value}}."""
         changes = OpenIDBackend.get_model_changes(openid_response, only_updatable=True,
                                                   attribute_set=attribute_set)
+        return cls.apply_model_changes(user_id, changes)
 
-        for model, kwargs in changes.items():
-            foreign_key_name = kwargs['user_id_field_name']
-            del kwargs['user_id_field_name']
-            model.objects.filter(**{foreign_key_name: user_id}).update(**kwargs)
+    @classmethod
+    def apply_model_changes(cls, user_id, changes):
+        """Write the values (see get_model_changes) which differ from the stored ones.
+        Returns the changed values {model: {field: value}}."""
+        res = {}
+        with transaction.atomic():
+            for model, kwargs in changes.items():
+                kwargs = dict(kwargs)
+                foreign_key_name = kwargs.pop('user_id_field_name')
+                if not kwargs:
+                    continue
+
+                records = model.objects.filter(**{foreign_key_name: user_id})
+                current = records.values(*kwargs.keys()).first()
+                if current is None:
+                    continue
+
+                changed = dict((field_name, value) for field_name, value in kwargs.items()
+                               if cls._is_changed(model, field_name, value, current[field_name]))
+                if changed:
+                    records.update(**changed)
+                    res[model] = changed
+
+        if res:
+            # update() doesn't send post_save
+            cls.clear_identity_cache(user_id)
 
-        return changes
+        return res
+
+    @classmethod
+    def submit_profile_update(cls, user_id, openid_response, attribute_set='default',
+                              digest=None):
+        """Capture the updatable attributes and let the MOJEID_EXECUTOR write them.
+        Each update gets a new attributes_version of the user's UserOpenID,
+        only the latest one is applied (see apply_profile_update).
+        The attributes digest is stored together with the update.
+        Returns the version or None when there is nothing to update."""
+        from django_mojeid.models import UserOpenID
+
+        changes = OpenIDBackend.get_model_changes(openid_response, only_updatable=True,
+                                                  attribute_set=attribute_set)
+        # models are passed by their labels
+        payload = dict(('%s.%s' % (model._meta.app_label, model._meta.object_name), kwargs)
+                       for model, kwargs in changes.items() if len(kwargs) > 1)
+        if not payload:
+            return None
+
+        with transaction.atomic():
+            records = UserOpenID.objects.filter(user_id=user_id)
+            records.update(attributes_version=F('attributes_version') + 1)
+            # the row is locked by the update until the end of the transaction
+            version = records.values_list('attributes_version', flat=True).get()
+
+        get_executor().submit(
+            PROFILE_UPDATE_TASK, (user_id, version, payload, digest), key='user:%s' % user_id,
+            retries=mojeid_settings.MOJEID_DEFERRED_PROFILE_UPDATE_RETRIES)
+        return version
+
+    @classmethod
+    def apply_profile_update(cls, user_id, version, payload, digest=None):
+        """Write the changes captured by submit_profile_update unless
+        a newer update of the user was submitted meanwhile."""
+        from django.db.models.loading import get_model
+        from django_mojeid.models import UserOpenID
+
+        changes = dict((get_model(*label.split('.')), kwargs) for label, kwargs in payload.items())
+
+        with transaction.atomic():
+            # the lock keeps newer updates from being submitted while this one is written
+            records = UserOpenID.objects.select_for_update() \
+                .filter(user_id=user_id, attributes_version=version)
+            if not records.exists():
+                logger.info("Skipping outdated profile update %d of user %s", version, user_id)
+                return {}
+            res = cls.apply_model_changes(user_id, changes)
+            if digest is not None:
+                # the same attributes are skipped from now on
+                records.update(attributes_digest=digest)
+            return res
+
+    @staticmethod
+    def _is_changed(model, field_name, value, current):
+        try:
+            value = model._meta.get_field(field_name).to_python(value)
+        except ValidationError:
+            # let the database decide
+            return True
+        return value != current
 
     @staticmethod
     def associate_openid_response(user, openid_response):
@@ -269,12 +462,13 @@ class OpenIDBackend:
         # Check to see if this OpenID has already been claimed.
         try:
             user_openid = UserOpenID.objects.get(
-                claimed_id__exact=claimed_id)
+                UserOpenID.claimed_id_filter(claimed_id))
         except UserOpenID.DoesNotExist:
             user_openid = UserOpenID(
                 user_id=user.pk,
                 claimed_id=claimed_id)
             user_openid.save()
+            user._mojeid_association = user_openid
         else:
             if user_openid.user_id != user.pk:
                 raise IdentityAlreadyClaimed(
@@ -285,8 +479,21 @@ class OpenIDBackend:
 
     @classmethod
     def get_user(cls, user_id):
+        cache = cls._get_identity_cache()
+        key = 'mojeid:user:%s' % user_id
+        user = cache.get(key) if cache else None
+        if user is not None:
+            return user
+
         try:
             user_model = get_user_model()
-            return user_model.objects.get(pk=user_id)
+            user = user_model.objects.get(pk=user_id)
         except user_model.DoesNotExist:
             return None
+
+        if cache:
+            cache.set(key, user, mojeid_settings.MOJEID_IDENTITY_CACHE_TIMEOUT)
+        return user
+
+
+register_task(PROFILE_UPDATE_TASK, OpenIDBackend.apply_profile_update)
@@ -0,0 +1,428 @@
+# django-mojeid-auth -  MojeID integration for django.contrib.auth
+#
+# Copyright (C) 2015 CZ.NIC
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Execution of the tasks outside of the login requests"""
+
+import logging
+import math
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import timedelta
+
+from django.db import close_old_connections, connection
+from django.utils import six, timezone
+from django.utils.six.moves import queue
+from django.utils.translation import ugettext_lazy as _
+
+from django_mojeid.exceptions import DjangoOpenIDException
+from django_mojeid.settings import mojeid_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class TaskNotFound(DjangoOpenIDException):
+    pass
+
+
+class TaskTimeout(DjangoOpenIDException):
+    """The task is still running in the abandoned thread"""
+
+    def __init__(self, message, run=None):
+        super(TaskTimeout, self).__init__(message)
+        self._run = run
+
+    def add_done_callback(self, callback):
+        """Call the callback when the abandoned thread finishes (from that thread),
+        or right away when it has already finished"""
+        if self._run is None or not self._run.add_callback(callback):
+            callback()
+
+
+class _TimedRun(object):
+    """Run of a task in a separate thread"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._finished = False
+
+    def add_callback(self, callback):
+        with self._lock:
+            if self._finished:
+                return False
+            self._callbacks.append(callback)
+            return True
+
+    def finish(self):
+        with self._lock:
+            self._finished = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Callback of the timed out task failed")
+
+
+# {task name: function}
+_tasks = {}
+
+
+def register_task(name, function):
+    _tasks[name] = function
+
+
+# number of the last execution times used to compute the percentiles
+STATS_SAMPLES = 1000
+
+# {task name: {'count': ..., 'total': ..., 'max': ..., 'failures': ..., 'timeouts': ...,
+#              'budget_exceeded': ...}}
+_stats = {}
+# {task name: deque of the last execution times}
+_samples = {}
+_stats_lock = threading.Lock()
+
+
+def record_task_stats(name, duration, failed=False, timed_out=False, budget_exceeded=False):
+    with _stats_lock:
+        stats = _stats.setdefault(
+            name, {'count': 0, 'total': 0.0, 'max': 0.0, 'failures': 0, 'timeouts': 0,
+                   'budget_exceeded': 0})
+        stats['count'] += 1
+        stats['total'] += duration
+        stats['max'] = max(stats['max'], duration)
+        if failed:
+            stats['failures'] += 1
+        if timed_out:
+            stats['timeouts'] += 1
+        if budget_exceeded:
+            stats['budget_exceeded'] += 1
+        _samples.setdefault(name, deque(maxlen=STATS_SAMPLES)).append(duration)
+
+
+def _percentile(ordered, percent):
+    # nearest-rank method
+    index = max(int(math.ceil(len(ordered) * percent / 100.0)) - 1, 0)
+    return ordered[index]
+
+
+def task_stats():
+    """Execution times (in seconds) of the tasks run by this process.
+    The percentiles are computed from the last STATS_SAMPLES runs."""
+    with _stats_lock:
+        res = {}
+        for name, stats in _stats.items():
+            stats = dict(stats)
+            ordered = sorted(_samples[name])
+            for percent in (50, 90, 99):
+                stats['p%d' % percent] = _percentile(ordered, percent)
+            res[name] = stats
+        return res
+
+
+def _run_with_timeout(function, args, timeout):
+    if not timeout:
+        return function(*args)
+
+    result = {}
+    run = _TimedRun()
+
+    def target():
+        try:
+            result['value'] = function(*args)
+        except Exception:
+            result['error'] = sys.exc_info()
+        finally:
+            try:
+                run.finish()
+            finally:
+                # the thread has its own connection
+                connection.close()
+
+    # the thread can't be killed, it is just abandoned when it runs too long
+    thread = threading.Thread(target=target, name='mojeid-task')
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TaskTimeout(_('Task did not finish in %s seconds.') % timeout, run)
+    if 'error' in result:
+        six.reraise(*result['error'])
+    return result.get('value')
+
+
+def execute_task(name, args=(), timeout=None):
+    """Run the task once and record its execution time"""
+    try:
+        function = _tasks[name]
+    except KeyError:
+        raise TaskNotFound(_('Task with name %s was not found.') % name)
+
+    return call_timed(name, function, args, timeout)
+
+
+def call_timed(name, function, args=(), timeout=None, budget=None):
+    """Call the function and record its execution time under the name.
+    A run which takes more than budget seconds is not interrupted,
+    it is just counted in budget_exceeded and logged."""
+    start = time.time()
+    try:
+        result = _run_with_timeout(function, args, timeout)
+    except TaskTimeout:
+        record_task_stats(name, time.time() - start, timed_out=True)
+        raise
+    except Exception:
+        record_task_stats(name, time.time() - start, failed=True)
+        raise
+    duration = time.time() - start
+    budget_exceeded = bool(budget) and duration > budget
+    record_task_stats(name, duration, budget_exceeded=budget_exceeded)
+    if budget_exceeded:
+        logger.warning("Task %s took %.3f s, its budget is %s s", name, duration, budget)
+    return result
+
+
+def run_task(name, args=(), retries=0, timeout=None):
+    """Run the task, failed attempts are repeated up to retries times.
+    A timeout is final as the timed out run may still be running."""
+    attempt = 0
+    while True:
+        try:
+            return execute_task(name, args, timeout)
+        except (TaskNotFound, TaskTimeout):
+            raise
+        except Exception:
+            if attempt >= retries:
+                raise
+            attempt += 1
+            logger.warning("Task %s failed, retrying (%d/%d)", name, attempt, retries,
+                           exc_info=True)
+            time.sleep(mojeid_settings.MOJEID_TASK_RETRY_DELAY)
+
+
+class ImmediateExecutor(object):
+    """Runs the tasks directly in the calling thread"""
+
+    def submit(self, name, args=(), key=None, retries=0, timeout=None):
+        run_task(name, args, retries, timeout)
+
+
+class ThreadPoolExecutor(object):
+    """Runs the tasks in the worker threads of this process.
+
+    The tasks with the same key are run one by one in the order of submission.
+    When a task times out, the next tasks of its key wait until the abandoned
+    run finishes while the worker moves on to the other keys.
+    The queued tasks are lost when the process exits.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or mojeid_settings.MOJEID_EXECUTOR_WORKERS
+        self._lock = threading.Lock()
+        # {key: deque of tasks}, the first task of the deque is being run
+        self._queues = {}
+        # keys which have tasks to run
+        self._ready = queue.Queue()
+        self._threads = []
+
+    def submit(self, name, args=(), key=None, retries=0, timeout=None):
+        if key is None:
+            # not ordered with any other task
+            key = object()
+        task = (name, args, retries, timeout)
+
+        with self._lock:
+            self._start_workers()
+            if key in self._queues:
+                # a worker is already processing the key
+                self._queues[key].append(task)
+                return
+            self._queues[key] = deque([task])
+        self._ready.put(key)
+
+    def _start_workers(self):
+        self._threads = [x for x in self._threads if x.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name='mojeid-executor')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            self._run_key(self._ready.get())
+
+    def _run_key(self, key):
+        while True:
+            with self._lock:
+                tasks = self._queues[key]
+                if not tasks:
+                    del self._queues[key]
+                    return
+                task = tasks[0]
+
+            try:
+                run_task(*task)
+            except TaskTimeout as e:
+                logger.exception("Task %s failed", task[0])
+                # the next task of the key must not run along with it,
+                # the key stays parked until the abandoned run finishes
+                e.add_done_callback(lambda: self._resume(key))
+                return
+            except Exception:
+                logger.exception("Task %s failed", task[0])
+            finally:
+                close_old_connections()
+
+            with self._lock:
+                tasks.popleft()
+
+    def _resume(self, key):
+        with self._lock:
+            self._queues[key].popleft()
+        self._ready.put(key)
+
+
+class DatabaseExecutor(object):
+    """Stores the tasks into the database, they are run by the
+    openid_process_tasks command.
+
+    The tasks with the same key are run one by one in the order of submission.
+    A timed out task stays running (blocking the next tasks of its key) until
+    the abandoned run finishes, then it is marked as failed.
+    """
+
+    # number of the pending tasks loaded at once
+    chunk_size = 100
+
+    def submit(self, name, args=(), key=None, retries=0, timeout=None):
+        from django_mojeid.models import DeferredTask
+
+        DeferredTask.objects.create(
+            name=name, args=DeferredTask.dump_args(args), key=key or '',
+            retries=retries, timeout=timeout,
+        )
+
+    def process(self, limit=None):
+        """Run the tasks which are due. Returns the number of processed tasks."""
+        from django_mojeid.models import DeferredTask
+
+        count = 0
+        # keys of the tasks which have to wait for a previous task
+        blocked = set()
+        now = timezone.now()
+
+        for task in self._pending_tasks(limit):
+            if limit is not None and count >= limit:
+                break
+
+            if task.key in blocked:
+                continue
+
+            if task.run_after > now or (task.key and DeferredTask.objects.filter(
+                    key=task.key, pk__lt=task.pk, state=DeferredTask.RUNNING).exists()):
+                if task.key:
+                    blocked.add(task.key)
+                continue
+
+            # claim the task (other workers may process the queue as well)
+            claimed = DeferredTask.objects.filter(pk=task.pk, state=DeferredTask.PENDING) \
+                .update(state=DeferredTask.RUNNING, error='')
+            if not claimed:
+                if task.key:
+                    blocked.add(task.key)
+                continue
+
+            count += 1
+            try:
+                execute_task(task.name, task.load_args(), task.timeout)
+            except Exception as e:
+                logger.exception("Task %s failed", task.name)
+                task.attempts += 1
+                task.error = traceback.format_exc()
+                if isinstance(e, TaskTimeout):
+                    # the task stays running so the next tasks of its key
+                    # wait until the abandoned run finishes
+                    task.save(update_fields=['attempts', 'error'])
+                    e.add_done_callback(lambda pk=task.pk: self._finish_timed_out(pk))
+                    if task.key:
+                        blocked.add(task.key)
+                    continue
+                if task.attempts > task.retries:
+                    task.state = DeferredTask.FAILED
+                else:
+                    task.state = DeferredTask.PENDING
+                    task.run_after = timezone.now() + timedelta(
+                        seconds=mojeid_settings.MOJEID_TASK_RETRY_DELAY * task.attempts)
+                    if task.key:
+                        blocked.add(task.key)
+                task.save()
+            else:
+                task.delete()
+
+        return count
+
+    @staticmethod
+    def _finish_timed_out(pk):
+        from django_mojeid.models import DeferredTask
+
+        DeferredTask.objects.filter(pk=pk, state=DeferredTask.RUNNING) \
+            .update(state=DeferredTask.FAILED)
+
+    def _pending_tasks(self, limit=None):
+        """Iterate over the pending tasks, they are loaded in chunks"""
+        from django_mojeid.models import DeferredTask
+
+        chunk_size = min(limit, self.chunk_size) if limit else self.chunk_size
+        pending = DeferredTask.objects.filter(state=DeferredTask.PENDING).order_by('pk')
+        last_pk = 0
+        while True:
+            tasks = list(pending.filter(pk__gt=last_pk)[:chunk_size])
+            for task in tasks:
+                yield task
+            if len(tasks) < chunk_size:
+                break
+            last_pk = tasks[-1].pk
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Executor of this process which is set in MOJEID_EXECUTOR"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            from django_mojeid.store import import_string
+            _executor = import_string(mojeid_settings.MOJEID_EXECUTOR)()
+    return _executor
@@ -27,14 +27,40 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import time
+from optparse import make_option
+
 from django.core.management.base import NoArgsCommand
 
-from django_mojeid.store import DjangoOpenIDStore
+from django_mojeid.store import get_store
 
 
 class Command(NoArgsCommand):
     help = 'Clean up stale OpenID associations and nonces'
 
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+                    default=1000,
+                    help='Number of rows deleted at once (0 deletes all the rows at once).'),
+        make_option('--pause', action='store', type='float', dest='pause', default=0,
+                    help='Seconds to wait between two batches.'),
+        make_option('--max-runtime', action='store', type='float', dest='max_runtime',
+                    default=None,
+                    help='Do not start a new batch after this number of seconds.'),
+    )
+
     def handle_noargs(self, **options):
-        store = DjangoOpenIDStore()
-        store.cleanup()
+        store = get_store()
+        verbosity = int(options.get('verbosity', 1))
+        deadline = time.time() + options['max_runtime'] \
+            if options['max_runtime'] is not None else None
+
+        for name, cleanup in (('nonces', store.cleanupNonces),
+                              ('associations', store.cleanupAssociations)):
+            start = time.time()
+            count = cleanup(batch_size=options['batch_size'], pause=options['pause'],
+                            deadline=deadline)
+            elapsed = time.time() - start
+            if verbosity >= 1:
+                self.stdout.write("%d expired %s removed in %.2f s (%.1f rows/s)" % (
+                    count, name, elapsed, count / elapsed if elapsed else 0.0))
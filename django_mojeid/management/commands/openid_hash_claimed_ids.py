@@ -0,0 +1,64 @@
+# django-openid-auth -  OpenID integration for django.contrib.auth
+#
+# Copyright (C) 2013 CZ.NIC
+# Copyright (C) 2009-2013 Canonical Ltd.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from django_mojeid.models import hash_claimed_ids
+
+
+class Command(NoArgsCommand):
+    help = 'Fill claimed_id_hash of the existing OpenID associations'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+                    default=1000,
+                    help='Number of rows updated in a single transaction.'),
+        make_option('--pause', action='store', type='float', dest='pause', default=0,
+                    help='Seconds to wait between two batches.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        start = time.time()
+
+        def progress(count):
+            if verbosity >= 2:
+                self.stdout.write("%d associations updated" % count)
+
+        count = hash_claimed_ids(batch_size=options['batch_size'], pause=options['pause'],
+                                 progress=progress)
+
+        if verbosity >= 1:
+            elapsed = time.time() - start
+            self.stdout.write("%d associations updated in %.2f s (%.1f rows/s)" % (
+                count, elapsed, count / elapsed if elapsed else 0.0))
@@ -0,0 +1,79 @@
+# django-openid-auth -  OpenID integration for django.contrib.auth
+#
+# Copyright (C) 2013 CZ.NIC
+# Copyright (C) 2009-2013 Canonical Ltd.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import close_old_connections
+
+# registers the profile update task
+import django_mojeid.auth  # noqa
+from django_mojeid.executors import DatabaseExecutor
+from django_mojeid.models import DeferredTask
+
+
+class Command(NoArgsCommand):
+    help = 'Run the tasks queued by the DatabaseExecutor'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--limit', action='store', type='int', dest='limit', default=None,
+                    help='Maximal number of tasks processed in a single pass.'),
+        make_option('--loop', action='store_true', dest='loop', default=False,
+                    help='Keep processing the queue until interrupted.'),
+        make_option('--sleep', action='store', type='float', dest='sleep', default=5,
+                    help='Seconds to wait when the queue is empty (with --loop).'),
+        make_option('--requeue', action='store_true', dest='requeue', default=False,
+                    help='Requeue the tasks left running by a crashed worker first.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        executor = DatabaseExecutor()
+
+        if options['requeue']:
+            running = DeferredTask.objects.filter(state=DeferredTask.RUNNING)
+            # the timed out tasks (their error is set) are not repeated
+            running.exclude(error='').update(state=DeferredTask.FAILED)
+            count = running.filter(error='').update(state=DeferredTask.PENDING)
+            if verbosity >= 1:
+                self.stdout.write("%d tasks requeued" % count)
+
+        while True:
+            start = time.time()
+            count = executor.process(limit=options['limit'])
+            if verbosity >= 2 or (verbosity >= 1 and count):
+                self.stdout.write("%d tasks processed in %.2f s" % (count, time.time() - start))
+
+            if not options['loop']:
+                break
+
+            close_old_connections()
+            if not count:
+                time.sleep(options['sleep'])
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import hashlib
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db.models import Count, Min
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'Nonce.server_url_hash'
+        # (server_url is too long to be a part of a unique key on MySQL)
+        db.add_column(u'django_mojeid_nonce', 'server_url_hash',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=40),
+                      keep_default=False)
+
+        if not db.dry_run:
+            # Fill the hashes (there are just a few distinct server urls)
+            for server_url in orm.Nonce.objects.values_list('server_url', flat=True).distinct():
+                orm.Nonce.objects.filter(server_url=server_url).update(
+                    server_url_hash=hashlib.sha1(server_url.encode('utf-8')).hexdigest())
+
+            # Remove duplicate nonces (keep the first one)
+            duplicates = orm.Nonce.objects.values('server_url_hash', 'timestamp', 'salt') \
+                .annotate(count=Count('id'), first_id=Min('id')).filter(count__gt=1)
+            for duplicate in duplicates:
+                orm.Nonce.objects.filter(
+                    server_url_hash=duplicate['server_url_hash'],
+                    timestamp=duplicate['timestamp'],
+                    salt=duplicate['salt']
+                ).exclude(id=duplicate['first_id']).delete()
+
+        # Adding unique constraint on 'Nonce', fields ['server_url_hash', 'timestamp', 'salt']
+        db.create_unique(u'django_mojeid_nonce', ['server_url_hash', 'timestamp', 'salt'])
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'Nonce', fields ['server_url_hash', 'timestamp', 'salt']
+        db.delete_unique(u'django_mojeid_nonce', ['server_url_hash', 'timestamp', 'salt'])
+
+        # Deleting field 'Nonce.server_url_hash'
+        db.delete_column(u'django_mojeid_nonce', 'server_url_hash')
+
+    models = {
+        u'django_mojeid.association': {
+            'Meta': {'object_name': 'Association'},
+            'assoc_type': ('django.db.models.fields.TextField', [], {'max_length': '64'}),
+            'handle': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'issued': ('django.db.models.fields.IntegerField', [], {}),
+            'lifetime': ('django.db.models.fields.IntegerField', [], {}),
+            'secret': ('django.db.models.fields.BinaryField', [], {'max_length': '255'}),
+            'server_url': ('django.db.models.fields.TextField', [], {'max_length': '2047'})
+        },
+        u'django_mojeid.nonce': {
+            'Meta': {'unique_together': "((u'server_url_hash', u'timestamp', u'salt'),)", 'object_name': 'Nonce'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'salt': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'server_url': ('django.db.models.fields.CharField', [], {'max_length': '2047'}),
+            'server_url_hash': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'timestamp': ('django.db.models.fields.IntegerField', [], {}),
+            'user_id': ('django.db.models.fields.IntegerField', [], {'null': 'True'})
+        },
+        u'django_mojeid.useropenid': {
+            'Meta': {'object_name': 'UserOpenID'},
+            'claimed_id': ('django.db.models.fields.TextField', [], {'unique': 'True', 'max_length': '2047'}),
+            'user_id': ('django.db.models.fields.IntegerField', [], {'primary_key': 'True'})
+        }
+    }
+
+    complete_apps = ['django_mojeid']
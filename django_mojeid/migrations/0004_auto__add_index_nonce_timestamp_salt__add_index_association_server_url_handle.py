@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import hashlib
+from south.db import db
+from south.v2 import SchemaMigration
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding index on 'Nonce', fields ['timestamp', 'salt']
+        db.create_index(u'django_mojeid_nonce', ['timestamp', 'salt'])
+
+        # Changing field 'Association.server_url'
+        db.alter_column(u'django_mojeid_association', 'server_url', self.gf('django.db.models.fields.CharField')(max_length=2047))
+
+        # Adding field 'Association.server_url_hash'
+        # (server_url is too long to be a part of an index on MySQL)
+        db.add_column(u'django_mojeid_association', 'server_url_hash',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=40),
+                      keep_default=False)
+
+        if not db.dry_run:
+            for server_url in orm.Association.objects.values_list('server_url', flat=True).distinct():
+                orm.Association.objects.filter(server_url=server_url).update(
+                    server_url_hash=hashlib.sha1(server_url.encode('utf-8')).hexdigest())
+
+        # Adding index on 'Association', fields ['server_url_hash', 'handle']
+        db.create_index(u'django_mojeid_association', ['server_url_hash', 'handle'])
+
+    def backwards(self, orm):
+        # Removing index on 'Association', fields ['server_url_hash', 'handle']
+        db.delete_index(u'django_mojeid_association', ['server_url_hash', 'handle'])
+
+        # Deleting field 'Association.server_url_hash'
+        db.delete_column(u'django_mojeid_association', 'server_url_hash')
+
+        # Changing field 'Association.server_url'
+        db.alter_column(u'django_mojeid_association', 'server_url', self.gf('django.db.models.fields.TextField')(max_length=2047))
+
+        # Removing index on 'Nonce', fields ['timestamp', 'salt']
+        db.delete_index(u'django_mojeid_nonce', ['timestamp', 'salt'])
+
+    models = {
+        u'django_mojeid.association': {
+            'Meta': {'object_name': 'Association', 'index_together': "((u'server_url_hash', u'handle'),)"},
+            'assoc_type': ('django.db.models.fields.TextField', [], {'max_length': '64'}),
+            'handle': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'issued': ('django.db.models.fields.IntegerField', [], {}),
+            'lifetime': ('django.db.models.fields.IntegerField', [], {}),
+            'secret': ('django.db.models.fields.BinaryField', [], {'max_length': '255'}),
+            'server_url': ('django.db.models.fields.CharField', [], {'max_length': '2047'}),
+            'server_url_hash': ('django.db.models.fields.CharField', [], {'max_length': '40'})
+        },
+        u'django_mojeid.nonce': {
+            'Meta': {'unique_together': "((u'server_url_hash', u'timestamp', u'salt'),)", 'object_name': 'Nonce', 'index_together': "((u'timestamp', u'salt'),)"},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'salt': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'server_url': ('django.db.models.fields.CharField', [], {'max_length': '2047'}),
+            'server_url_hash': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'timestamp': ('django.db.models.fields.IntegerField', [], {}),
+            'user_id': ('django.db.models.fields.IntegerField', [], {'null': 'True'})
+        },
+        u'django_mojeid.useropenid': {
+            'Meta': {'object_name': 'UserOpenID'},
+            'claimed_id': ('django.db.models.fields.TextField', [], {'unique': 'True', 'max_length': '2047'}),
+            'user_id': ('django.db.models.fields.IntegerField', [], {'primary_key': 'True'})
+        }
+    }
+
+    complete_apps = ['django_mojeid']
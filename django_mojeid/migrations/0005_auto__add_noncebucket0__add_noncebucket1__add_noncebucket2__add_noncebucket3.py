@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+from south.db import db
+from south.v2 import SchemaMigration
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'NonceBucket0'
+        db.create_table(u'django_mojeid_noncebucket0', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('server_url', self.gf('django.db.models.fields.CharField')(max_length=2047)),
+            ('server_url_hash', self.gf('django.db.models.fields.CharField')(max_length=40)),
+            ('timestamp', self.gf('django.db.models.fields.IntegerField')()),
+            ('salt', self.gf('django.db.models.fields.CharField')(max_length=40)),
+        ))
+        db.send_create_signal(u'django_mojeid', ['NonceBucket0'])
+
+        # Adding unique constraint on 'NonceBucket0', fields ['server_url_hash', 'timestamp', 'salt']
+        db.create_unique(u'django_mojeid_noncebucket0', ['server_url_hash', 'timestamp', 'salt'])
+
+        # Adding model 'NonceBucket1'
+        db.create_table(u'django_mojeid_noncebucket1', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('server_url', self.gf('django.db.models.fields.CharField')(max_length=2047)),
+            ('server_url_hash', self.gf('django.db.models.fields.CharField')(max_length=40)),
+            ('timestamp', self.gf('django.db.models.fields.IntegerField')()),
+            ('salt', self.gf('django.db.models.fields.CharField')(max_length=40)),
+        ))
+        db.send_create_signal(u'django_mojeid', ['NonceBucket1'])
+
+        # Adding unique constraint on 'NonceBucket1', fields ['server_url_hash', 'timestamp', 'salt']
+        db.create_unique(u'django_mojeid_noncebucket1', ['server_url_hash', 'timestamp', 'salt'])
+
+        # Adding model 'NonceBucket2'
+        db.create_table(u'django_mojeid_noncebucket2', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('server_url', self.gf('django.db.models.fields.CharField')(max_length=2047)),
+            ('server_url_hash', self.gf('django.db.models.fields.CharField')(max_length=40)),
+            ('timestamp', self.gf('django.db.models.fields.IntegerField')()),
+            ('salt', self.gf('django.db.models.fields.CharField')(max_length=40)),
+        ))
+        db.send_create_signal(u'django_mojeid', ['NonceBucket2'])
+
+        # Adding unique constraint on 'NonceBucket2', fields ['server_url_hash', 'timestamp', 'salt']
+        db.create_unique(u'django_mojeid_noncebucket2', ['server_url_hash', 'timestamp', 'salt'])
+
+        # Adding model 'NonceBucket3'
+        db.create_table(u'django_mojeid_noncebucket3', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('server_url', self.gf('django.db.models.fields.CharField')(max_length=2047)),
+            ('server_url_hash', self.gf('django.db.models.fields.CharField')(max_length=40)),
+            ('timestamp', self.gf('django.db.models.fields.IntegerField')()),
+            ('salt', self.gf('django.db.models.fields.CharField')(max_length=40)),
+        ))
+        db.send_create_signal(u'django_mojeid', ['NonceBucket3'])
+
+        # Adding unique constraint on 'NonceBucket3', fields ['server_url_hash', 'timestamp', 'salt']
+        db.create_unique(u'django_mojeid_noncebucket3', ['server_url_hash', 'timestamp', 'salt'])
+
+    def backwards(self, orm):
+        # Deleting model 'NonceBucket0'
+        db.delete_table(u'django_mojeid_noncebucket0')
+
+        # Deleting model 'NonceBucket1'
+        db.delete_table(u'django_mojeid_noncebucket1')
+
+        # Deleting model 'NonceBucket2'
+        db.delete_table(u'django_mojeid_noncebucket2')
+
+        # Deleting model 'NonceBucket3'
+        db.delete_table(u'django_mojeid_noncebucket3')
+
+    models = {
+        u'django_mojeid.association': {
+            'Meta': {'object_name': 'Association', 'index_together': "((u'server_url_hash', u'handle'),)"},
+            'assoc_type': ('django.db.models.fields.TextField', [], {'max_length': '64'}),
+            'handle': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'issued': ('django.db.models.fields.IntegerField', [], {}),
+            'lifetime': ('django.db.models.fields.IntegerField', [], {}),
+            'secret': ('django.db.models.fields.BinaryField', [], {'max_length': '255'}),
+            'server_url': ('django.db.models.fields.CharField', [], {'max_length': '2047'}),
+            'server_url_hash': ('django.db.models.fields.CharField', [], {'max_length': '40'})
+        },
+        u'django_mojeid.nonce': {
+            'Meta': {'unique_together': "((u'server_url_hash', u'timestamp', u'salt'),)", 'object_name': 'Nonce', 'index_together': "((u'timestamp', u'salt'),)"},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'salt': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'server_url': ('django.db.models.fields.CharField', [], {'max_length': '2047'}),
+            'server_url_hash': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'timestamp': ('django.db.models.fields.IntegerField', [], {}),
+            'user_id': ('django.db.models.fields.IntegerField', [], {'null': 'True'})
+        },
+        u'django_mojeid.noncebucket0': {
+            'Meta': {'unique_together': "((u'server_url_hash', u'timestamp', u'salt'),)", 'object_name': 'NonceBucket0'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'salt': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'server_url': ('django.db.models.fields.CharField', [], {'max_length': '2047'}),
+            'server_url_hash': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'timestamp': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'django_mojeid.noncebucket1': {
+            'Meta': {'unique_together': "((u'server_url_hash', u'timestamp', u'salt'),)", 'object_name': 'NonceBucket1'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'salt': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'server_url': ('django.db.models.fields.CharField', [], {'max_length': '2047'}),
+            'server_url_hash': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'timestamp': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'django_mojeid.noncebucket2': {
+            'Meta': {'unique_together': "((u'server_url_hash', u'timestamp', u'salt'),)", 'object_name': 'NonceBucket2'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'salt': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'server_url': ('django.db.models.fields.CharField', [], {'max_length': '2047'}),
+            'server_url_hash': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'timestamp': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'django_mojeid.noncebucket3': {
+            'Meta': {'unique_together': "((u'server_url_hash', u'timestamp', u'salt'),)", 'object_name': 'NonceBucket3'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'salt': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'server_url': ('django.db.models.fields.CharField', [], {'max_length': '2047'}),
+            'server_url_hash': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'timestamp': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'django_mojeid.useropenid': {
+            'Meta': {'object_name': 'UserOpenID'},
+            'claimed_id': ('django.db.models.fields.TextField', [], {'unique': 'True', 'max_length': '2047'}),
+            'user_id': ('django.db.models.fields.IntegerField', [], {'primary_key': 'True'})
+        }
+    }
+
+    complete_apps = ['django_mojeid']
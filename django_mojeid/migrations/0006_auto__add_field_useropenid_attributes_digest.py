@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from south.db import db
+from south.v2 import SchemaMigration
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'UserOpenID.attributes_digest'
+        db.add_column(u'django_mojeid_useropenid', 'attributes_digest',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=40, blank=True),
+                      keep_default=False)
+
+    def backwards(self, orm):
+        # Deleting field 'UserOpenID.attributes_digest'
+        db.delete_column(u'django_mojeid_useropenid', 'attributes_digest')
+
+    models = {
+        u'django_mojeid.association': {
+            'Meta': {'object_name': 'Association', 'index_together': "((u'server_url_hash', u'handle'),)"},
+            'assoc_type': ('django.db.models.fields.TextField', [], {'max_length': '64'}),
+            'handle': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'issued': ('django.db.models.fields.IntegerField', [], {}),
+            'lifetime': ('django.db.models.fields.IntegerField', [], {}),
+            'secret': ('django.db.models.fields.BinaryField', [], {'max_length': '255'}),
+            'server_url': ('django.db.models.fields.CharField', [], {'max_length': '2047'}),
+            'server_url_hash': ('django.db.models.fields.CharField', [], {'max_length': '40'})
+        },
+        u'django_mojeid.nonce': {
+            'Meta': {'unique_together': "((u'server_url_hash', u'timestamp', u'salt'),)", 'object_name': 'Nonce', 'index_together': "((u'timestamp', u'salt'),)"},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'salt': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'server_url': ('django.db.models.fields.CharField', [], {'max_length': '2047'}),
+            'server_url_hash': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'timestamp': ('django.db.models.fields.IntegerField', [], {}),
+            'user_id': ('django.db.models.fields.IntegerField', [], {'null': 'True'})
+        },
+        u'django_mojeid.noncebucket0': {
+            'Meta': {'unique_together': "((u'server_url_hash', u'timestamp', u'salt'),)", 'object_name': 'NonceBucket0'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'salt': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'server_url': ('django.db.models.fields.CharField', [], {'max_length': '2047'}),
+            'server_url_hash': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'timestamp': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'django_mojeid.noncebucket1': {
+            'Meta': {'unique_together': "((u'server_url_hash', u'timestamp', u'salt'),)", 'object_name': 'NonceBucket1'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'salt': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'server_url': ('django.db.models.fields.CharField', [], {'max_length': '2047'}),
+            'server_url_hash': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'timestamp': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'django_mojeid.noncebucket2': {
+            'Meta': {'unique_together': "((u'server_url_hash', u'timestamp', u'salt'),)", 'object_name': 'NonceBucket2'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'salt': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'server_url': ('django.db.models.fields.CharField', [], {'max_length': '2047'}),
+            'server_url_hash': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'timestamp': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'django_mojeid.noncebucket3': {
+            'Meta': {'unique_together': "((u'server_url_hash', u'timestamp', u'salt'),)", 'object_name': 'NonceBucket3'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'salt': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'server_url': ('django.db.models.fields.CharField', [], {'max_length': '2047'}),
+            'server_url_hash': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'timestamp': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'django_mojeid.useropenid': {
+            'Meta': {'object_name': 'UserOpenID'},
+            'attributes_digest': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '40', 'blank': 'True'}),
+            'claimed_id': ('django.db.models.fields.TextField', [], {'unique': 'True', 'max_length': '2047'}),
+            'user_id': ('django.db.models.fields.IntegerField', [], {'primary_key': 'True'})
+        }
+    }
+
+    complete_apps = ['django_mojeid']
@@ -29,9 +29,27 @@
 
 from __future__ import unicode_literals
 
-from django.db import models
+import hashlib
+import json
+import time
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 
+from django_mojeid.settings import mojeid_settings
+
+try:
+    # django >= 1.8
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
 try:
     # python3
     from urllib.parse import urlparse, urldefrag
@@ -40,13 +58,29 @@ except ImportError:
     from urlparse import urlparse, urldefrag
 
 
+def hash_server_url(server_url):
+    """server_url is too long to be indexed (e.g. by MySQL), its digest is indexed instead"""
+    return hashlib.sha1(server_url.encode('utf-8')).hexdigest()
+
+
 @python_2_unicode_compatible
 class Nonce(models.Model):
     user_id = models.IntegerField(null=True)
     server_url = models.CharField(max_length=2047)
+    # digest of server_url (set in save)
+    server_url_hash = models.CharField(max_length=40, editable=False)
     timestamp = models.IntegerField()
     salt = models.CharField(max_length=40)
 
+    class Meta:
+        unique_together = (('server_url_hash', 'timestamp', 'salt'), )
+        # cleanup and registration nonce lookup
+        index_together = (('timestamp', 'salt'), )
+
+    def save(self, *args, **kwargs):
+        self.server_url_hash = hash_server_url(self.server_url)
+        super(Nonce, self).save(*args, **kwargs)
+
     def __str__(self):
         return "Nonce: %s, %s" % (self.server_url, self.salt)
 
@@ -64,15 +98,68 @@ class Nonce(models.Model):
         return cls.objects.get(timestamp=timestamp, salt=salt)
 
 
+@python_2_unicode_compatible
+class NonceBucket(models.Model):
+    """Nonces used by BucketedNonceStore
+
+    Each bucket holds nonces whose timestamps belong to the same SKEW long
+    window, so all the nonces of an expired window can be removed at once.
+    """
+    server_url = models.CharField(max_length=2047)
+    # digest of server_url (set in save)
+    server_url_hash = models.CharField(max_length=40, editable=False)
+    timestamp = models.IntegerField()
+    salt = models.CharField(max_length=40)
+
+    class Meta:
+        abstract = True
+        unique_together = (('server_url_hash', 'timestamp', 'salt'), )
+
+    def save(self, *args, **kwargs):
+        self.server_url_hash = hash_server_url(self.server_url)
+        super(NonceBucket, self).save(*args, **kwargs)
+
+    def __str__(self):
+        return "Nonce: %s, %s" % (self.server_url, self.salt)
+
+
+class NonceBucket0(NonceBucket):
+    pass
+
+
+class NonceBucket1(NonceBucket):
+    pass
+
+
+class NonceBucket2(NonceBucket):
+    pass
+
+
+class NonceBucket3(NonceBucket):
+    pass
+
+
+NONCE_BUCKETS = (NonceBucket0, NonceBucket1, NonceBucket2, NonceBucket3)
+
+
 @python_2_unicode_compatible
 class Association(models.Model):
-    server_url = models.TextField(max_length=2047)
+    server_url = models.CharField(max_length=2047)
+    # digest of server_url (set in save)
+    server_url_hash = models.CharField(max_length=40, editable=False)
     handle = models.CharField(max_length=255)
     secret = models.BinaryField(max_length=255)
     issued = models.IntegerField()
     lifetime = models.IntegerField()
     assoc_type = models.TextField(max_length=64)
 
+    class Meta:
+        index_together = (('server_url_hash', 'handle'), )
+
+    def save(self, *args, **kwargs):
+        self.server_url_hash = hash_server_url(self.server_url)
+        super(Association, self).save(*args, **kwargs)
+
     def __str__(self):
         return "Association: %s, %s" % (self.server_url, self.handle)
 
@@ -81,6 +168,45 @@ class Association(models.Model):
 class UserOpenID(models.Model):
     user_id = models.IntegerField(primary_key=True)
     claimed_id = models.TextField(max_length=2047, unique=True)
+    # indexable digest of claimed_id (set in save)
+    claimed_id_hash = models.CharField(max_length=40, unique=True, editable=False)
+    # digest of the attributes applied during the last login
+    attributes_digest = models.CharField(max_length=40, blank=True, default='')
+    # incremented for each deferred profile update (see OpenIDBackend.submit_profile_update)
+    attributes_version = models.BigIntegerField(default=0, editable=False)
+
+    @staticmethod
+    def hash_claimed_id(claimed_id):
+        return hashlib.sha1(claimed_id.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def claimed_id_filter(cls, claimed_id):
+        """Filter which looks up the claimed_id using claimed_id_hash.
+        The rows without claimed_id_hash (see openid_hash_claimed_ids)
+        are compared by claimed_id while MOJEID_CLAIMED_ID_HASH_FALLBACK is set."""
+        query = Q(claimed_id_hash=cls.hash_claimed_id(claimed_id))
+        if mojeid_settings.MOJEID_CLAIMED_ID_HASH_FALLBACK:
+            query |= Q(claimed_id_hash__isnull=True, claimed_id=claimed_id)
+        return query
+
+    @classmethod
+    def claimed_id_where(cls, claimed_id):
+        """The same as claimed_id_filter as an SQL condition for QuerySet.extra()
+        Returns (where, params)"""
+        qn = connection.ops.quote_name
+        table = qn(cls._meta.db_table)
+        hash_column = '%s.%s' % (table, qn('claimed_id_hash'))
+        where = '%s = %%s' % hash_column
+        params = [cls.hash_claimed_id(claimed_id)]
+        if mojeid_settings.MOJEID_CLAIMED_ID_HASH_FALLBACK:
+            where = '(%s OR (%s IS NULL AND %s.%s = %%s))' % (
+                where, hash_column, table, qn('claimed_id'))
+            params.append(claimed_id)
+        return where, params
+
+    def save(self, *args, **kwargs):
+        self.claimed_id_hash = self.hash_claimed_id(self.claimed_id)
+        super(UserOpenID, self).save(*args, **kwargs)
 
     @property
     def name(self):
@@ -92,3 +218,99 @@ class UserOpenID(models.Model):
 
     def __str__(self):
         return self.name
+
+
+def hash_claimed_ids(model=None, batch_size=1000, pause=0, progress=None):
+    """Fill claimed_id_hash of the rows which don't have it yet, batch_size rows
+    are updated in a single transaction. The model can be the frozen UserOpenID
+    of a migration. progress is called with the number of rows updated so far.
+    Returns the number of updated rows."""
+    if model is None:
+        model = UserOpenID
+
+    count = 0
+    while True:
+        records = list(model.objects.filter(claimed_id_hash__isnull=True)
+                       .order_by('pk').values_list('pk', 'claimed_id')[:batch_size])
+        if not records:
+            break
+
+        with transaction.atomic():
+            for pk, claimed_id in records:
+                model.objects.filter(pk=pk).update(
+                    claimed_id_hash=UserOpenID.hash_claimed_id(claimed_id))
+
+        count += len(records)
+        if progress is not None:
+            progress(count)
+        if len(records) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+
+    return count
+
+
+@python_2_unicode_compatible
+class DeferredTask(models.Model):
+    """Task queued by the DatabaseExecutor"""
+    PENDING = 0
+    RUNNING = 1
+    FAILED = 2
+    STATE_CHOICES = (
+        (PENDING, 'pending'),
+        (RUNNING, 'running'),
+        (FAILED, 'failed'),
+    )
+
+    name = models.CharField(max_length=255)
+    # JSON encoded arguments (unpickling would let anybody who can write
+    # into the table run code in the worker)
+    args = models.TextField()
+    # tasks with the same key are run in the order of creation
+    key = models.CharField(max_length=255, blank=True, db_index=True)
+    state = models.SmallIntegerField(choices=STATE_CHOICES, default=PENDING)
+    retries = models.PositiveIntegerField(default=0)
+    attempts = models.PositiveIntegerField(default=0)
+    timeout = models.FloatField(null=True, blank=True)
+    run_after = models.DateTimeField(default=timezone.now)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        index_together = (('state', 'run_after'), )
+
+    @staticmethod
+    def dump_args(args):
+        return json.dumps(list(args), cls=DjangoJSONEncoder)
+
+    def load_args(self):
+        return json.loads(self.args)
+
+    def __str__(self):
+        return "DeferredTask: %s, %s" % (self.name, self.get_state_display())
+
+
+@receiver(setting_changed, dispatch_uid='mojeid_attribute_plans')
+def clear_attribute_plans(**kwargs):
+    # mojeid.py is imported from settings.py so it can't connect the signal
+    if kwargs['setting'] in ('MOJEID_ATTRIBUTES', 'MOJEID_ATTRIBUTES_SETS'):
+        from django_mojeid.mojeid import clear_attribute_plans
+        clear_attribute_plans()
+
+
+@receiver(post_save, dispatch_uid='mojeid_user_save_cache')
+@receiver(post_delete, dispatch_uid='mojeid_user_delete_cache')
+def clear_user_identity_cache(sender, **kwargs):
+    # connected here as models.py is always loaded, the user model can't be
+    # used as the sender as it might not be loaded yet
+    if '%s.%s' % (sender._meta.app_label, sender._meta.object_name) != settings.AUTH_USER_MODEL:
+        return
+    from django_mojeid.auth import OpenIDBackend
+    OpenIDBackend.clear_identity_cache(kwargs['instance'].pk)
+
+
+@receiver(post_save, sender=UserOpenID, dispatch_uid='mojeid_association_save_cache')
+@receiver(post_delete, sender=UserOpenID, dispatch_uid='mojeid_association_delete_cache')
+def clear_association_identity_cache(**kwargs):
+    from django_mojeid.auth import OpenIDBackend
+    OpenIDBackend.clear_identity_cache(kwargs['instance'].user_id)
@@ -31,15 +31,24 @@
 
 from __future__ import unicode_literals
 
+import copy
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
 from urlparse import urlparse
 
 from django.core.exceptions import FieldError, ImproperlyConfigured
 from django.http import Http404
+from django.utils import six
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import ugettext
 
+from openid.association import SessionNegotiator
 from openid.consumer.consumer import GenericConsumer, FailureResponse, SUCCESS
 from openid.consumer.discover import OpenIDServiceEndpoint
+from openid.extension import Extension
 from openid.extensions import ax, pape
 
 from django_mojeid.exceptions import RequiredAttributeNotReturned
@@ -84,11 +93,22 @@ mojeid_services = {
 }
 
 
+# parsed endpoints {'testing': endpoint, 'production': endpoint}
+_services = {}
+
+
 def create_service():
     endpoint_type = 'production' if mojeid_settings.MOJEID_INSTANCE_PRODUCTION \
                     else 'testing'
-    defs = mojeid_services[endpoint_type]
-    return OpenIDServiceEndpoint.fromXRDS(defs['url'], defs['xrds'])[0]
+    try:
+        service = _services[endpoint_type]
+    except KeyError:
+        # parse the xrds only once
+        defs = mojeid_services[endpoint_type]
+        service = OpenIDServiceEndpoint.fromXRDS(defs['url'], defs['xrds'])[0]
+        _services[endpoint_type] = service
+    # the caller might modify the endpoint
+    return copy.copy(service)
 
 
 def get_registration_url():
@@ -98,6 +118,87 @@ def get_registration_url():
 
 
 class MojeIDConsumer(GenericConsumer):
+
+    # negotiation statistics of this process
+    _negotiation_lock = threading.Lock()
+    _negotiation_counts = {'negotiated': 0, 'coalesced': 0, 'wait_timeouts': 0}
+
+    def __init__(self, store):
+        super(MojeIDConsumer, self).__init__(store)
+        association_types = mojeid_settings.MOJEID_ASSOCIATION_TYPES
+        if association_types is not None:
+            # the first one is preferred
+            self.negotiator = SessionNegotiator(association_types)
+
+    @classmethod
+    def negotiation_info(cls):
+        """Statistics of the association negotiations"""
+        with cls._negotiation_lock:
+            return dict(cls._negotiation_counts)
+
+    @classmethod
+    def _count_negotiation(cls, name):
+        with cls._negotiation_lock:
+            cls._negotiation_counts[name] += 1
+
+    def _getAssociation(self, endpoint):
+        association = self.store.getAssociation(endpoint.server_url)
+        if association is None or association.expiresIn <= 0:
+            association = self.negotiate_association(endpoint)
+        return association
+
+    def negotiate_association(self, endpoint, min_expires_in=0):
+        """Negotiate a new association and save it into the store.
+
+        Only one process negotiates the association with the server at once
+        (the lock is kept in MOJEID_CACHE). The other ones wait for the
+        association which is valid for more than min_expires_in seconds.
+        """
+        from django_mojeid.store import get_cache
+
+        cache = get_cache(mojeid_settings.MOJEID_CACHE)
+        lock_key = 'mojeid:negotiation:%s' % hashlib.sha1(
+            endpoint.server_url.encode('utf-8')).hexdigest()
+
+        if not cache.add(lock_key, 1, mojeid_settings.MOJEID_ASSOCIATION_LOCK_TIMEOUT):
+            # somebody else is negotiating the association
+            deadline = time.time() + mojeid_settings.MOJEID_ASSOCIATION_LOCK_WAIT
+            while time.time() < deadline:
+                time.sleep(0.1)
+                association = self.load_stored_association(endpoint.server_url)
+                if association is not None and association.expiresIn > min_expires_in:
+                    self._count_negotiation('coalesced')
+                    return association
+            self._count_negotiation('wait_timeouts')
+            # negotiate it on our own
+            return self._negotiate_and_store(endpoint)
+
+        try:
+            # the association might have been stored before we got the lock
+            association = self.load_stored_association(endpoint.server_url)
+            if association is not None and association.expiresIn > min_expires_in:
+                self._count_negotiation('coalesced')
+                return association
+            return self._negotiate_and_store(endpoint)
+        finally:
+            cache.delete(lock_key)
+
+    def load_stored_association(self, server_url):
+        """Load the newest association shared by all the processes,
+        the in-process cache of the store is bypassed"""
+        reload_association = getattr(self.store, 'reloadAssociation', None)
+        if reload_association is None:
+            # other stores don't cache the associations in the process
+            return self.store.getAssociation(server_url)
+        return reload_association(server_url)
+
+    def _negotiate_and_store(self, endpoint):
+        association = self._negotiateAssociation(endpoint)
+        if association is not None:
+            self.store.storeAssociation(endpoint.server_url, association)
+        self._count_negotiation('negotiated')
+        return association
+
     def _verifyDiscoverySingle(self, endpoint, to_match):
         """This function normally verifies that the result (obtained from
         the mojeid server matches with xrds used in the beginning but as this
@@ -131,45 +232,218 @@ class MojeIDConsumer(GenericConsumer):
         return response
 
 
-def get_attributes(attribute_set):
-
+def _get_attribute_sets():
     default = getattr(mojeid_settings, 'MOJEID_ATTRIBUTES', [])
-    res = getattr(mojeid_settings, 'MOJEID_ATTRIBUTES_SETS', {})
+    res = dict(getattr(mojeid_settings, 'MOJEID_ATTRIBUTES_SETS', {}))
 
     # MOJEID_ATTRIBUTES are default when present
     if default or not res:
         res['default'] = default
 
+    return res
+
+
+class AXValues(ax.FetchResponse):
+    """ax.FetchResponse which is empty when the response contains no AX values"""
+
+    def __init__(self, fetch_response=None):
+        super(AXValues, self).__init__()
+        if fetch_response is None:
+            return
+        # {type_uri: [values]}
+        self.data = dict((type_uri, list(values))
+                         for type_uri, values in fetch_response.data.items())
+        self.update_url = fetch_response.update_url
+
+
+def get_ax_values(openid_response):
+    """ Return AXValues of the response, the AX response is parsed only once """
     try:
-        return res[attribute_set]
+        return openid_response._mojeid_ax_values
+    except AttributeError:
+        values = AXValues(ax.FetchResponse.fromSuccessResponse(openid_response))
+        openid_response._mojeid_ax_values = values
+        return values
+
+
+def get_attributes_digest(openid_response, attribute_set='default'):
+    """ Return the digest of the attributes obtained in the response
+    (changing the attribute set configuration changes the digest as well) """
+    payload = json.dumps([
+        attribute_set,
+        get_attribute_plan(attribute_set).fingerprint,
+        openid_response.getDisplayIdentifier(),
+        get_ax_values(openid_response).data,
+    ], sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class PrebuiltExtension(Extension):
+    """Extension with arguments computed in advance"""
+
+    def __init__(self, extension):
+        self.ns_uri = extension.ns_uri
+        self.ns_alias = extension.ns_alias
+        self._args = extension.getExtensionArgs()
+
+    def getExtensionArgs(self):
+        return self._args
+
+
+def _group_by_model(attributes):
+    res = OrderedDict()
+    for attribute in attributes:
+        res.setdefault(attribute.model, []).append(attribute)
+    return res
+
+
+class AttributePlan(object):
+    """Attributes of an attribute set prepared for the login"""
+
+    def __init__(self, attributes):
+        self.attributes = attributes
+
+        # attributes which are stored into the models
+        model_attributes = [x for x in attributes if x.type in ('attribute', 'internal')]
+        for attribute in model_attributes:
+            attribute.validate()
+        self.by_model = _group_by_model(model_attributes)
+        self.updatable_by_model = _group_by_model([x for x in model_attributes if x.updatable])
+
+        self.registration_attributes = [
+            x for x in attributes
+            if x.type == 'attribute' and hasattr(x, 'registration_field') and x.use_for_registration
+        ]
+        self.handlers = self._resolve_handlers([x for x in attributes if x.type == 'handler'])
+        self.query = self._get_query(attributes)
+        self.fingerprint = self._get_fingerprint(attributes)
+
+        if self.query:
+            fetch_request = ax.FetchRequest()
+            for attribute, required in self.query:
+                fetch_request.add(attribute.generate_ax_attrinfo(required))
+            self.ax_extension = PrebuiltExtension(fetch_request)
+        else:
+            self.ax_extension = None
+
+    @staticmethod
+    def _resolve_handlers(custom_handlers):
+        """ Return [(custom_handler, handler)] """
+        if not custom_handlers:
+            return []
+        # settings.py imports this module so the handlers can't be imported sooner
+        from django_mojeid.attribute_handlers import registry
+        return registry.resolve(custom_handlers)
+
+    @staticmethod
+    def _get_fingerprint(attributes):
+        """ Return the description of the attributes and of the way they are stored """
+        res = []
+        for attribute in attributes:
+            cls = type(attribute)
+            if attribute.type == 'handler':
+                res.append([attribute.type, attribute.name,
+                            '%s.%s' % (type(attribute.attribute).__module__,
+                                       type(attribute.attribute).__name__)])
+            else:
+                res.append([attribute.type, '%s.%s' % (cls.__module__, cls.__name__),
+                            attribute.modelApp, attribute.modelClass, attribute.modelAttribute,
+                            attribute.user_id_field_name, attribute.updatable])
+        return res
+
+    @staticmethod
+    def _get_query(attributes):
+        """ Return attributes without duplicities """
+        used_dict = {}
+        filtered_attributes = []
+        for attribute in attributes:
+
+            # Skip for the Internal attributes
+            if attribute.type == 'internal':
+                continue
+
+            required = attribute.required
+            attribute = attribute.attribute if attribute.type == 'handler' else attribute
+
+            if attribute.code in used_dict:
+                if not filtered_attributes[used_dict[attribute.code]][1]:
+                    # required=true has higher priority
+                    filtered_attributes[used_dict[attribute.code]] = (attribute, required, )
+            else:
+                used_dict[attribute.code] = len(filtered_attributes)
+                filtered_attributes.append((attribute, required, ))
+
+        return filtered_attributes
+
+
+# {attribute_set: AttributePlan}
+_attribute_plans = {}
+
+
+def clear_attribute_plans():
+    _attribute_plans.clear()
+
+
+def get_attribute_plan(attribute_set='default'):
+    try:
+        return _attribute_plans[attribute_set]
+    except KeyError:
+        pass
+
+    try:
+        attributes = _get_attribute_sets()[attribute_set]
     except KeyError:
         raise Http404
 
+    plan = AttributePlan(attributes)
+    _attribute_plans[attribute_set] = plan
+    return plan
 
-def get_attribute_query(attribute_set='defualt'):
-    """ Return attributes without duplicities """
-    attributes = get_attributes(attribute_set)
 
-    used_dict = {}
-    filtered_attributes = []
-    for attribute in attributes:
+def get_attributes(attribute_set):
+    return get_attribute_plan(attribute_set).attributes
+
 
-        # Skip for the Internal attributes
-        if attribute.type == 'internal':
-            continue
+# {(login method, max auth age): PrebuiltExtension}
+_pape_extensions = {}
 
-        required = attribute.required
-        attribute = attribute.attribute if attribute.type == 'handler' else attribute
 
-        if attribute.code in used_dict:
-            if not filtered_attributes[used_dict[attribute.code]][1]:
-                # required=true has higher priority
-                filtered_attributes[used_dict[attribute.code]] = (attribute, required, )
+def _get_pape_extension():
+    key = (mojeid_settings.MOJEID_LOGIN_METHOD, mojeid_settings.MOJEID_MAX_AUTH_AGE)
+    try:
+        return _pape_extensions[key]
+    except KeyError:
+        pass
+
+    login_method, max_auth_age = key
+    extension = None
+    if login_method != 'ANY' or max_auth_age is not None:
+        # set authentication method to OTP or CERT
+        if login_method == "OTP":
+            auth_method = [pape.AUTH_MULTI_FACTOR]
+        elif login_method == "CERT":
+            auth_method = [pape.AUTH_PHISHING_RESISTANT]
         else:
-            used_dict[attribute.code] = len(filtered_attributes)
-            filtered_attributes.append((attribute, required, ))
+            auth_method = None
+
+        extension = PrebuiltExtension(pape.Request(
+            preferred_auth_policies=auth_method,
+            max_auth_age=max_auth_age,
+        ))
+
+    _pape_extensions[key] = extension
+    return extension
+
+
+def get_login_extensions(attribute_set='default'):
+    """ Return the extensions which are added to the login request """
+    extensions = [get_attribute_plan(attribute_set).ax_extension, _get_pape_extension()]
+    return [x for x in extensions if x is not None]
 
-    return filtered_attributes
+
+def get_attribute_query(attribute_set='default'):
+    """ Return attributes without duplicities """
+    return get_attribute_plan(attribute_set).query
 
 
 class CustomHandler(object):
@@ -195,6 +469,8 @@ class Attribute(object):
         self.required = required
         self.updatable = updatable
         self._model = None
+        self._validated = False
+        self._concrete = False
 
     @property
     def model(self):
@@ -224,20 +500,88 @@ class Attribute(object):
     def _get_value(cls, response):
         return None
 
+    def validate(self):
+        """ Check that the model attribute exists, the check is done only once """
+        if self._validated:
+            return
+
+        fields = self.model._meta.fields
+        if self.modelAttribute in [x.name for x in fields] + [x.attname for x in fields]:
+            self._concrete = True
+        else:
+            # Not a model field, but it can still be e.g. a property
+            if not hasattr(self.model, self.modelAttribute):
+                raise FieldError(
+                    _("Cannot resolve keyword '%(model)s' into field. "
+                      "Choices are: %(choices)s") %
+                    {"model": self.modelAttribute,
+                     "choices": ", ".join(self.model._meta.get_all_field_names())})
+        self._validated = True
+
+    @property
+    def concrete(self):
+        """ Whether the value is stored in a model field """
+        self.validate()
+        return self._concrete
+
     def set_model_value(self, id, value):
-        record = self._get_record(id)
-        if not hasattr(record, self.modelAttribute):
-            raise FieldError(
-                _("Cannot resolve keyword '%(model)s' into field. "
-                  "Choices are: %(choices)s") %
-                {"model": self.modelAttribute,
-                 "choices": ", ".join(record._meta._name_map.keys())})
-        self._set(record, self.modelAttribute, value)
-        record.save()
+        set_model_values(id, {self: value})
+
+    def _overwritten(self, name):
+        """ Whether the method was overwritten using inheritance """
+        return six.get_unbound_function(getattr(type(self), name)) is not \
+            six.get_unbound_function(getattr(Attribute, name))
 
     # This method could be overwritten using inheritance
     def _get_model_value(self, id):
-        return getattr(self._get_record(id), self.modelAttribute)
+        return self._get_record_value(self._get_record(id))
+
+    # This method could be overwritten using inheritance
+    def _get_record_value(self, record):
+        return getattr(record, self.modelAttribute)
+
+    def get_model_value(self, id, record=None):
+        """ Read the value from the record when it was already fetched
+        (unless _get_model_value is overwritten) """
+        if record is None or self._overwritten('_get_model_value'):
+            return self._get_model_value(id)
+        return self._get_record_value(record)
+
+    @property
+    def record_key(self):
+        """Attributes with the same key are stored in the same record"""
+        return (self.model, self.user_id_field_name)
+
+
+def set_model_values(id, values):
+    """ Store the values of the attributes {attribute: value}
+    Each record is fetched and saved only once """
+    by_record = OrderedDict()
+    for attribute, value in values.items():
+        attribute.validate()
+        by_record.setdefault(attribute.record_key, []).append((attribute, value))
+
+    for items in by_record.values():
+        record = items[0][0]._get_record(id)
+        for attribute, value in items:
+            attribute._set(record, attribute.modelAttribute, value)
+
+        if all(attribute.concrete and not attribute._overwritten('_set')
+               for attribute, _value in items):
+            record.save(update_fields=[attribute.modelAttribute for attribute, _value in items])
+        else:
+            # Properties and overwritten _set may modify any field
+            record.save()
+
+
+def get_records(attributes, id):
+    """ Fetch the records of the attributes, each record is fetched only once
+    Returns {attribute.record_key: record} """
+    records = {}
+    for attribute in attributes:
+        if attribute.record_key not in records:
+            records[attribute.record_key] = attribute._get_record(id)
+    return records
 
 
 class MojeIDAttribute(Attribute):
@@ -273,12 +617,12 @@ class MojeIDAttribute(Attribute):
             )
         return value
 
-    def registration_form_attrs(self, id):
+    def registration_form_attrs(self, id, record=None):
         # Return none if registration field is not present
         if not hasattr(self, 'registration_field') or not self.use_for_registration:
             return None
 
-        value = self._get_model_value(id)
+        value = self.get_model_value(id, record)
         # No value present
         if value is None:
             return None
@@ -289,9 +633,9 @@ class MojeIDAttribute(Attribute):
     def _get_form_html_template(self):
         return '<label for="%s">%s</label><input type="text" name="%s" value="%s">'
 
-    def registration_form_attrs_html(self, id):
+    def registration_form_attrs_html(self, id, record=None):
 
-        field = self.registration_form_attrs(id)
+        field = self.registration_form_attrs(id, record)
 
         # Field was not obtained.
         if not field:
@@ -0,0 +1,98 @@
+# django-mojeid-auth -  MojeID integration for django.contrib.auth
+#
+# Copyright (C) 2015 CZ.NIC
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Negotiation of the associations outside of the login requests"""
+
+import logging
+import threading
+
+from django.db import connection
+
+from django_mojeid.mojeid import create_service, MojeIDConsumer
+from django_mojeid.settings import mojeid_settings
+from django_mojeid.store import get_store
+
+
+logger = logging.getLogger(__name__)
+
+
+def refresh_association(consumer=None, endpoint=None, margin=None):
+    """Make sure that the store contains an association with the endpoint
+    which is valid for at least margin seconds.
+
+    Returns the association or None when it could not be negotiated.
+    """
+    consumer = consumer or MojeIDConsumer(get_store())
+    endpoint = endpoint or create_service()
+    if margin is None:
+        margin = mojeid_settings.MOJEID_ASSOCIATION_RENEW_MARGIN
+
+    association = consumer.load_stored_association(endpoint.server_url)
+    if association is not None and association.expiresIn > margin:
+        return association
+
+    return consumer.negotiate_association(endpoint, min_expires_in=margin)
+
+
+class AssociationRefresher(threading.Thread):
+    """Calls refresh_association every interval seconds"""
+
+    def __init__(self, interval=None, margin=None):
+        super(AssociationRefresher, self).__init__(name='mojeid-association-refresher')
+        self.daemon = True
+        self.interval = interval or mojeid_settings.MOJEID_ASSOCIATION_REFRESH_INTERVAL
+        self.margin = margin
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                refresh_association(margin=self.margin)
+            except Exception:
+                logger.exception("Failed to refresh the mojeID association")
+            finally:
+                # the thread has its own connection
+                connection.close()
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+
+
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+def start_association_refresher():
+    """Start the refresher thread of this process unless it is running"""
+    global _refresher
+    with _refresher_lock:
+        if _refresher is None or not _refresher.is_alive():
+            _refresher = AssociationRefresher()
+            _refresher.start()
+    return _refresher
@@ -8,6 +8,28 @@ MOJEID_LOGIN_METHOD = "ANY"
 MOJEID_INSTANCE_PRODUCTION = False
 MOJEID_MAX_AUTH_AGE = None
 MOJEID_SESSION_NEXT_PAGE_ATTR = 'mojeid_next_page'
+MOJEID_STORE = 'django_mojeid.store.DjangoOpenIDStore'
+MOJEID_CACHE = 'default'
+MOJEID_ATOMIC_NONCES = True
+MOJEID_NONCE_CLEANUP_INTERVAL = None
+MOJEID_NONCE_CLEANUP_PROBABILITY = None
+MOJEID_NONCE_CLEANUP_BATCH_SIZE = 100
+MOJEID_ASSOCIATION_LRU_SIZE = 0
+MOJEID_ASSOCIATION_LRU_MAX_AGE = 30
+MOJEID_ASSOCIATION_REFRESH = False
+MOJEID_ASSOCIATION_REFRESH_INTERVAL = 60
+MOJEID_ASSOCIATION_RENEW_MARGIN = 300
+MOJEID_ASSOCIATION_LOCK_TIMEOUT = 30
+MOJEID_ASSOCIATION_LOCK_WAIT = 5
+MOJEID_ASSOCIATION_TYPES = None
+MOJEID_SKIP_UNCHANGED_ATTRIBUTES = False
+MOJEID_IDENTITY_CACHE_TIMEOUT = None
+MOJEID_CLAIMED_ID_HASH_FALLBACK = False
+MOJEID_EXECUTOR = 'django_mojeid.executors.ThreadPoolExecutor'
+MOJEID_EXECUTOR_WORKERS = 2
+MOJEID_TASK_RETRY_DELAY = 5
+MOJEID_DEFERRED_PROFILE_UPDATE = False
+MOJEID_DEFERRED_PROFILE_UPDATE_RETRIES = 3
 
 class Settings(object):
     def __getattr__(self, name):
@@ -30,6 +52,30 @@ class Settings(object):
                 (isinstance(attr, int) and attr >= 0)):
             raise ImproperlyConfigured(
                 "MOJEID_MAX_AUTH_AGE must be a positive integer (>= 0) or None")
+
+        if name == 'MOJEID_NONCE_CLEANUP_INTERVAL' and not (
+                attr is None or
+                (isinstance(attr, int) and attr > 0)):
+            raise ImproperlyConfigured(
+                "MOJEID_NONCE_CLEANUP_INTERVAL must be a positive integer (> 0) or None")
+
+        if name == 'MOJEID_NONCE_CLEANUP_PROBABILITY' and not (
+                attr is None or
+                (isinstance(attr, (int, float)) and 0 <= attr <= 1)):
+            raise ImproperlyConfigured(
+                "MOJEID_NONCE_CLEANUP_PROBABILITY must be a number between 0 and 1 or None")
+
+        if name == 'MOJEID_ASSOCIATION_TYPES' and attr is not None:
+            from openid.association import checkSessionType
+            try:
+                if not attr:
+                    raise ValueError
+                for assoc_type, session_type in attr:
+                    checkSessionType(assoc_type, session_type)
+            except (TypeError, ValueError):
+                raise ImproperlyConfigured(
+                    "MOJEID_ASSOCIATION_TYPES must be a non-empty list of valid "
+                    "(association type, session type) pairs or None")
         return attr
 
 mojeid_settings = Settings()
@@ -31,6 +31,8 @@ from django.db.models.signals import post_delete
 from django.dispatch import Signal, receiver
 from django.contrib.auth import get_user_model
 
+from django_mojeid.models import UserOpenID
+
 
 user_login_report = Signal(providing_args=[
     'request', 'username', 'user_id', 'method', 'success'])
@@ -47,10 +49,8 @@ user_model = get_user_model()
 
 @receiver(post_delete, sender=user_model, dispatch_uid='user_delete')
 def delete_association(**kwargs):
-
-    from django_mojeid.models import UserOpenID
-
     sender = kwargs['sender']
     user = kwargs['instance']
     if sender == user_model:
         UserOpenID.objects.filter(user_id=user.pk).delete()
+
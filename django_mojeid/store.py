@@ -27,25 +27,103 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import hashlib
+import itertools
+import random
+import threading
 import time
+from collections import OrderedDict
 
 from openid.association import Association as OIDAssociation
 from openid.store.interface import OpenIDStore
 from openid.store.nonce import SKEW
 
+from django.db import IntegrityError, connections, router, transaction
 from django.db.models import F
 
-from django_mojeid.models import Association, Nonce
+try:
+    # django >= 1.7
+    from django.core.cache import caches
+    from django.utils.module_loading import import_string
+
+    def get_cache(alias):
+        return caches[alias]
+except ImportError:
+    # django 1.6
+    from django.core.cache import get_cache
+    from django.utils.module_loading import import_by_path as import_string
+
+from django_mojeid.models import Association, Nonce, NONCE_BUCKETS, hash_server_url
+from django_mojeid.settings import mojeid_settings
+
+
+def get_store():
+    """Return an instance of the store set in MOJEID_STORE"""
+    return import_string(mojeid_settings.MOJEID_STORE)()
+
+
+def delete_in_batches(queryset, batch_size=None, pause=0, deadline=None,
+                      max_batches=None):
+    """Delete the rows of the queryset and return their count
+
+    When batch_size is set the rows are deleted by primary keys in batches
+    of batch_size rows, sleeping pause seconds between the batches.
+    No other batch is started after the deadline (unix time) is reached
+    or when max_batches batches were deleted.
+    """
+    if not batch_size:
+        count = queryset.count()
+        if count:
+            queryset.delete()
+        return count
+
+    count = 0
+    batches = itertools.count(1)
+    while deadline is None or time.time() < deadline:
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        queryset.model.objects.filter(pk__in=pks).delete()
+        count += len(pks)
+        if len(pks) < batch_size:
+            break
+        if max_batches is not None and next(batches) >= max_batches:
+            break
+        if pause:
+            time.sleep(pause)
+    return count
+
+
+def truncate_table(model):
+    """Remove all the rows of the model table at once"""
+    connection = connections[router.db_for_write(model)]
+    table = connection.ops.quote_name(model._meta.db_table)
+    cursor = connection.cursor()
+    if connection.vendor == 'sqlite':
+        # sqlite truncates the table when DELETE has no WHERE clause
+        cursor.execute('DELETE FROM %s' % table)
+    else:
+        cursor.execute('TRUNCATE TABLE %s' % table)
 
 
 class DjangoOpenIDStore(OpenIDStore):
 
+    # number of the used nonces in this process
+    _nonce_counter = itertools.count(1)
+
+    # associations used by this process {(server_url, handle): (association, loaded at)}
+    _associations = OrderedDict()
+    _associations_lock = threading.Lock()
+    _associations_hits = 0
+    _associations_misses = 0
+
     def __init__(self):
         self.max_nonce_age = 6 * 60 * 60  # Six hours
 
     def storeAssociation(self, server_url, association):
         try:
             assoc = Association.objects.get(
+                server_url_hash=hash_server_url(server_url),
                 server_url=server_url, handle=association.handle)
         except Association.DoesNotExist:
             assoc = Association(
@@ -61,14 +139,86 @@ class DjangoOpenIDStore(OpenIDStore):
             assoc.lifetime = association.lifetime
             assoc.assoc_type = association.assoc_type
         assoc.save()
+        with self._associations_lock:
+            self._associations.pop((server_url, association.handle), None)
+            # the newest association might have changed
+            self._associations.pop((server_url, None), None)
+
+    @classmethod
+    def association_cache_info(cls):
+        """Statistics of the in-process association cache"""
+        with cls._associations_lock:
+            return {
+                'hits': DjangoOpenIDStore._associations_hits,
+                'misses': DjangoOpenIDStore._associations_misses,
+                'size': len(cls._associations),
+                'max_size': mojeid_settings.MOJEID_ASSOCIATION_LRU_SIZE,
+            }
+
+    def _get_local(self, server_url, handle):
+        with self._associations_lock:
+            entry = self._associations.pop((server_url, handle), None)
+            if entry is not None:
+                association, loaded = entry
+                # the other processes might have removed or replaced the association
+                fresh = time.time() - loaded < mojeid_settings.MOJEID_ASSOCIATION_LRU_MAX_AGE
+                if fresh and association.expiresIn > 0:
+                    # move to the end (most recently used)
+                    self._associations[(server_url, handle)] = entry
+                    DjangoOpenIDStore._associations_hits += 1
+                    return association
+            DjangoOpenIDStore._associations_misses += 1
+            return None
+
+    def _set_local(self, server_url, handle, association, max_size):
+        with self._associations_lock:
+            self._associations.pop((server_url, handle), None)
+            self._associations[(server_url, handle)] = (association, time.time())
+            while len(self._associations) > max_size:
+                # remove the least recently used one
+                self._associations.popitem(last=False)
+
+    def _remove_local(self, server_url, handle):
+        with self._associations_lock:
+            self._associations.pop((server_url, handle), None)
+            latest = self._associations.get((server_url, None))
+            if latest is not None and latest[0].handle == handle:
+                del self._associations[(server_url, None)]
 
     def getAssociation(self, server_url, handle=None):
+        max_size = mojeid_settings.MOJEID_ASSOCIATION_LRU_SIZE
+        if not max_size:
+            return self._load_association(server_url, handle)
+
+        association = self._get_local(server_url, handle)
+        if association is None:
+            association = self._load_association(server_url, handle)
+            if association is not None:
+                self._set_local(server_url, handle, association, max_size)
+        return association
+
+    def reloadAssociation(self, server_url, handle=None):
+        """Same as getAssociation but the association is loaded from the
+        storage shared by the processes (bypassing the in-process cache)"""
+        association = self._load_association(server_url, handle)
+        max_size = mojeid_settings.MOJEID_ASSOCIATION_LRU_SIZE
+        if max_size:
+            if association is None:
+                self._remove_local(server_url, handle)
+            else:
+                self._set_local(server_url, handle, association, max_size)
+        return association
+
+    def _load_association(self, server_url, handle=None):
         assocs = []
         if handle is not None:
             assocs = Association.objects.filter(
+                server_url_hash=hash_server_url(server_url),
                 server_url=server_url, handle=handle)
         else:
-            assocs = Association.objects.filter(server_url=server_url)
+            assocs = Association.objects.filter(
+                server_url_hash=hash_server_url(server_url),
+                server_url=server_url)
         associations = []
         expired = []
         for assoc in assocs:
@@ -91,7 +241,9 @@ class DjangoOpenIDStore(OpenIDStore):
         return associations[-1][1]
 
     def removeAssociation(self, server_url, handle):
+        self._remove_local(server_url, handle)
         assocs = list(Association.objects.filter(
+            server_url_hash=hash_server_url(server_url),
             server_url=server_url, handle=handle))
         assocs_exist = len(assocs) > 0
         for assoc in assocs:
@@ -102,34 +254,166 @@ class DjangoOpenIDStore(OpenIDStore):
         if abs(timestamp - time.time()) > SKEW:
             return False
 
+        if not mojeid_settings.MOJEID_ATOMIC_NONCES:
+            if Nonce.objects.filter(
+                    server_url_hash=hash_server_url(server_url),
+                    server_url__exact=server_url,
+                    timestamp__exact=timestamp,
+                    salt__exact=salt).exists():
+                return False
+
+        # (server_url_hash, timestamp, salt) is unique
+        # so the insert fails when the nonce was already used
         try:
-            ononce = Nonce.objects.get(
-                server_url__exact=server_url,
-                timestamp__exact=timestamp,
-                salt__exact=salt)
-        except Nonce.DoesNotExist:
-            ononce = Nonce(
-                server_url=server_url,
-                timestamp=timestamp,
-                salt=salt)
-            ononce.save()
-            return True
+            with transaction.atomic():
+                Nonce.objects.create(
+                    server_url=server_url,
+                    timestamp=timestamp,
+                    salt=salt)
+        except IntegrityError:
+            return False
 
-        return False
+        self._expire_nonces()
 
-    def cleanupNonces(self, _now=None):
+        return True
+
+    def _expire_nonces(self):
+        """Remove a small batch of the expired nonces
+        after every MOJEID_NONCE_CLEANUP_INTERVAL-th used nonce
+        or with MOJEID_NONCE_CLEANUP_PROBABILITY probability
+        """
+        interval = mojeid_settings.MOJEID_NONCE_CLEANUP_INTERVAL
+        probability = mojeid_settings.MOJEID_NONCE_CLEANUP_PROBABILITY
+        if interval:
+            expire = next(DjangoOpenIDStore._nonce_counter) % interval == 0
+        elif probability:
+            expire = random.random() < probability
+        else:
+            return
+
+        if expire:
+            self._delete_expired_nonces(
+                batch_size=mojeid_settings.MOJEID_NONCE_CLEANUP_BATCH_SIZE, max_batches=1)
+
+    def _delete_expired_nonces(self, _now=None, batch_size=None, pause=0, deadline=None,
+                               max_batches=None):
+        """Delete the expired rows of the Nonce table"""
         if _now is None:
             _now = int(time.time())
         expired = Nonce.objects.filter(timestamp__lt=_now - SKEW)
-        count = expired.count()
-        if count:
-            expired.delete()
-        return count
+        return delete_in_batches(expired, batch_size, pause, deadline, max_batches)
 
-    def cleanupAssociations(self):
+    def cleanupNonces(self, _now=None, batch_size=None, pause=0, deadline=None,
+                      max_batches=None):
+        return self._delete_expired_nonces(_now, batch_size, pause, deadline, max_batches)
+
+    def cleanupAssociations(self, batch_size=None, pause=0, deadline=None):
         expired = Association.objects.filter(
             issued__lt=(int(time.time()) - F('lifetime')))
-        count = expired.count()
-        if count:
-            expired.delete()
-        return count
+        return delete_in_batches(expired, batch_size, pause, deadline)
+
+
+class CachedDjangoOpenIDStore(DjangoOpenIDStore):
+    """Keeps the associations in the django cache (MOJEID_CACHE).
+
+    The database is queried only when the association is not cached.
+    Every association is cached until it expires and all the changes
+    are written both into the cache and into the database.
+    """
+
+    def __init__(self):
+        super(CachedDjangoOpenIDStore, self).__init__()
+        self.cache = get_cache(mojeid_settings.MOJEID_CACHE)
+
+    @staticmethod
+    def _cache_key(server_url, handle=None):
+        # server_url and handle might not be valid cache keys
+        key = server_url if handle is None else '%s\n%s' % (server_url, handle)
+        return 'mojeid:association:%s' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _get_cached(self, server_url, handle=None):
+        data = self.cache.get(self._cache_key(server_url, handle))
+        if data is None:
+            return None
+        return OIDAssociation.deserialize(data)
+
+    def _set_cached(self, server_url, association, latest=False):
+        timeout = association.expiresIn
+        if timeout <= 0:
+            return
+        data = association.serialize()
+        self.cache.set(self._cache_key(server_url, association.handle), data, timeout)
+        if latest:
+            # association which is returned when no handle is given
+            self.cache.set(self._cache_key(server_url), data, timeout)
+
+    def storeAssociation(self, server_url, association):
+        super(CachedDjangoOpenIDStore, self).storeAssociation(server_url, association)
+        latest = self._get_cached(server_url)
+        self._set_cached(server_url, association,
+                         latest=latest is None or latest.issued <= association.issued)
+
+    def _load_association(self, server_url, handle=None):
+        association = self._get_cached(server_url, handle)
+        if association is not None and association.expiresIn > 0:
+            return association
+
+        association = super(CachedDjangoOpenIDStore, self)._load_association(
+            server_url, handle)
+        if association is not None:
+            self._set_cached(server_url, association, latest=handle is None)
+        return association
+
+    def removeAssociation(self, server_url, handle):
+        self.cache.delete(self._cache_key(server_url, handle))
+        latest = self._get_cached(server_url)
+        if latest is not None and latest.handle == handle:
+            self.cache.delete(self._cache_key(server_url))
+        return super(CachedDjangoOpenIDStore, self).removeAssociation(server_url, handle)
+
+
+class BucketedNonceStore(DjangoOpenIDStore):
+    """Stores the nonces into rotating bucket tables (NONCE_BUCKETS).
+
+    Each bucket holds the nonces of one SKEW long window of timestamps.
+    Only the current, the previous and the next windows can contain usable
+    nonces, so the bucket of the window after the next one contains only
+    the expired nonces and the cleanup just truncates its table.
+    """
+
+    @staticmethod
+    def _get_bucket(timestamp):
+        return NONCE_BUCKETS[(timestamp // SKEW) % len(NONCE_BUCKETS)]
+
+    def useNonce(self, server_url, timestamp, salt):
+        if abs(timestamp - time.time()) > SKEW:
+            return False
+
+        try:
+            with transaction.atomic():
+                self._get_bucket(timestamp).objects.create(
+                    server_url=server_url,
+                    timestamp=timestamp,
+                    salt=salt)
+        except IntegrityError:
+            return False
+
+        self._expire_nonces()
+
+        return True
+
+    def cleanupNonces(self, _now=None, batch_size=None, pause=0, deadline=None,
+                      max_batches=None):
+        """Truncate the expired bucket and delete the expired registration nonces.
+        Only the deleted registration nonces are counted (counting the bucket
+        would scan the whole table)."""
+        if _now is None:
+            _now = int(time.time())
+
+        # TRUNCATE takes an exclusive lock (or commits the transaction on MySQL)
+        # so it is run only here and never from _expire_nonces during the logins
+        truncate_table(self._get_bucket(_now + 2 * SKEW))
+
+        # registration nonces are still stored in Nonce
+        return super(BucketedNonceStore, self).cleanupNonces(
+            _now, batch_size, pause, deadline, max_batches)
@@ -49,7 +49,6 @@ from django.views.decorators.http import require_POST
 
 from openid.consumer.consumer import SUCCESS, CANCEL, FAILURE
 from openid.cryptutil import randomString
-from openid.extensions import ax, pape
 from openid.fetchers import HTTPFetchingError
 from openid.kvform import dictToKV
 from openid.message import Message
@@ -64,10 +63,12 @@ from django_mojeid.exceptions import (
     IdentityAlreadyClaimed,
 )
 from django_mojeid.models import Nonce, UserOpenID
+from django_mojeid.refresher import start_association_refresher
 from django_mojeid.mojeid import (
     Assertion,
-    get_attributes,
-    get_attribute_query,
+    get_attribute_plan,
+    get_login_extensions,
+    get_records,
     get_registration_url,
     create_service,
     MojeIDConsumer
@@ -79,7 +80,7 @@ from django_mojeid.signals import (
     authenticate_user,
     associate_user
 )
-from django_mojeid.store import DjangoOpenIDStore
+from django_mojeid.store import get_store
 
 
 SESSION_ATTR_SET_KEY = 'mojeid_attr_set'
@@ -132,37 +133,21 @@ def login_begin(request, attribute_set='default'):
     if mojeid_settings.MOJEID_SESSION_NEXT_PAGE_ATTR in request.session:
         del request.session[mojeid_settings.MOJEID_SESSION_NEXT_PAGE_ATTR]
 
+    if mojeid_settings.MOJEID_ASSOCIATION_REFRESH:
+        # negotiate the associations in background
+        start_association_refresher()
+
     # create consumer, start login process
-    consumer = MojeIDConsumer(DjangoOpenIDStore())
+    consumer = MojeIDConsumer(get_store())
     openid_request = consumer.begin(create_service())
 
     # Request user details.
-    attributes = get_attribute_query(attribute_set)
+    extensions = get_login_extensions(attribute_set)
     # save settings set name for response handler
     request.session[SESSION_ATTR_SET_KEY] = attribute_set
 
-    fetch_request = ax.FetchRequest()
-    for attribute, required in attributes:
-        fetch_request.add(attribute.generate_ax_attrinfo(required))
-
-    if attributes:
-        openid_request.addExtension(fetch_request)
-
-    if mojeid_settings.MOJEID_LOGIN_METHOD != 'ANY' or \
-            mojeid_settings.MOJEID_MAX_AUTH_AGE is not None:
-        # set authentication method to OTP or CERT
-        if mojeid_settings.MOJEID_LOGIN_METHOD == "OTP":
-            auth_method = [pape.AUTH_MULTI_FACTOR]
-        elif mojeid_settings.MOJEID_LOGIN_METHOD == "CERT":
-            auth_method = [pape.AUTH_PHISHING_RESISTANT]
-        else:
-            auth_method = None
-
-        pape_request = pape.Request(
-            preferred_auth_policies=auth_method,
-            max_auth_age=mojeid_settings.MOJEID_MAX_AUTH_AGE,
-        )
-        openid_request.addExtension(pape_request)
+    for extension in extensions:
+        openid_request.addExtension(extension)
 
     # Construct the request completion URL
     return_to = request.build_absolute_uri(reverse(login_complete))
@@ -200,11 +185,13 @@ def registration(request, attribute_set='default',
     nonce.save()
 
     fields = []
-    attributes = [x for x in get_attributes(attribute_set) if x.type == 'attribute']
+    attributes = get_attribute_plan(attribute_set).registration_attributes
     # Append attributes to creation request if user is valid
     if user:
+        records = get_records(attributes, user_id)
         for attribute in attributes:
-            form_attr = attribute.registration_form_attrs_html(user_id)
+            form_attr = attribute.registration_form_attrs_html(
+                user_id, records[attribute.record_key])
             if form_attr:
                 fields.append(form_attr)
 
@@ -239,7 +226,7 @@ def login_complete(request):
 
     endpoint = create_service()
     message = Message.fromPostArgs(request.REQUEST)
-    consumer = MojeIDConsumer(DjangoOpenIDStore())
+    consumer = MojeIDConsumer(get_store())
 
     try:
         openid_response = consumer.complete(
@@ -296,7 +283,8 @@ def login_complete(request):
             user_id = None
             try:
                 # Try to get user id
-                user_id = UserOpenID.objects.get(claimed_id=openid_response.identity_url).user_id
+                user_id = UserOpenID.objects.get(
+                    UserOpenID.claimed_id_filter(openid_response.identity_url)).user_id
             except (UserOpenID.DoesNotExist, user_model.DoesNotExist):
                 # Report an error with identity_url
                 user_login_report.send(
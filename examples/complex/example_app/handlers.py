@@ -5,7 +5,8 @@ from __future__ import unicode_literals, print_function
 from django_mojeid.attribute_handlers import register_handler
 
 
-@register_handler('full_name_handler')
+# deferred handlers are run after the login redirect
+@register_handler('full_name_handler', deferred=True, retries=2, timeout=10)
 def print_fullname_to_console(user, full_name):
     print('Full name >>>', full_name, '<<< for user ', user)
 